@@ -0,0 +1,253 @@
+"""
+Live top N boards pushed to clients as server sent events by the ASGI app.
+
+A process holds one subscription to the update announcements of SCOREBOARD_UPDATES_CHANNEL
+for all its clients. Announced cohorts are marked dirty, and every SCOREBOARD_LIVE_INTERVAL
+seconds the top of each dirty cohort is read once, diffed against what was last pushed for
+each requested size and the same rendered diff is queued for every client of that size.
+A client first gets a `snapshot` event with the whole top N, then `diff` events.
+"""
+import asyncio
+import json
+import logging
+import re
+import threading
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import QueryDict
+
+from cohorts.scoreboard import fetchDegradedRankList, loadRankListAsync
+from cohorts.serializer import LiveScoreboardSerializer, renderScoreboard
+from commons import metrics
+from commons.redis import REDIS_UNAVAILABLE_ERRORS, subscribeRedisChannel
+
+logger = logging.getLogger(__name__)
+
+# Served next to the other scoreboard urls, included under batch/.
+LIVE_PATH = re.compile(r'^/batch/(?P<cohort_id>\d+)/scoreboard/live$')
+KEEPALIVE_EVENT = b': keepalive\n\n'
+
+CLIENTS = metrics.gauge('scoreboard_live_clients', 'Clients streaming live boards from this process.')
+
+def diffRankLists(previous, current):
+    """
+    Returns None when both ranklists are equal, else the changes turning `previous` into
+    `current` as {"size", "changed", "removed"}: `changed` lists the {rank, email, score}
+    of the rows whose member or score moved, rows not listed keep their rank, and
+    `removed` the emails which left the board.
+    """
+    if previous == current:
+        return None
+    ranks = {email: (rank, score) for rank, (email, score) in enumerate(previous, 1)}
+    kept = {email for email, _ in current}
+    return {
+        "size": len(current),
+        "changed": [
+            {"rank": rank, "email": email, "score": score}
+            for rank, (email, score) in enumerate(current, 1) if ranks.get(email) != (rank, score)
+        ],
+        "removed": [email for email, _ in previous if email not in kept],
+    }
+
+def sseEvent(name, data):
+    return b'event: ' + name + b'\ndata: ' + data + b'\n\n'
+
+async def fetchTopRankList(cohort_id, limit):
+    """
+    Read past the page cache of the process, which may not have seen the announcement yet.
+    """
+    try:
+        return list((await loadRankListAsync(cohort_id, 0, limit))[0])
+    except REDIS_UNAVAILABLE_ERRORS:
+        return list(await sync_to_async(fetchDegradedRankList)(cohort_id, 0, limit))
+
+
+class LiveScoreboards:
+    """
+    Clients of the process, as {cohort_id: {limit: set of event queues}}, all served from
+    the event loop of the ASGI server. Only the subscriber threads call `notify`.
+    """
+
+    def __init__(self):
+        self.subscribers = {}
+        self.sent = {}
+        self.dirty = set()
+        self.loop = None
+        self.ticker = None
+        self.listener = None
+        self.lock = threading.Lock()
+
+    def ensureListener(self):
+        with self.lock:
+            if self.listener is None:
+                self.listener = subscribeRedisChannel(
+                    settings.SCOREBOARD_UPDATES_CHANNEL,
+                    lambda cohort_id: self.notify(int(cohort_id)),
+                    on_reconnect=self.notifyAll,
+                )
+
+    def callSoon(self, callback, *args):
+        loop = self.loop
+        if loop is None:
+            return
+        try:
+            loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # The loop was closed, its clients are gone.
+            pass
+
+    def notify(self, cohort_id):
+        if cohort_id in self.subscribers:
+            self.callSoon(self.dirty.add, cohort_id)
+
+    def notifyAll(self):
+        # Announcements may have been missed while resubscribing.
+        self.callSoon(lambda: self.dirty.update(self.subscribers))
+
+    def countClients(self):
+        CLIENTS.set(sum(len(queues) for limits in self.subscribers.values() for queues in limits.values()))
+
+    async def subscribe(self, cohort_id, limit):
+        """
+        Returns the event queue of a new client of the top `limit` of the cohort, holding
+        its snapshot event.
+        """
+        self.ensureListener()
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop, self.ticker = loop, None
+        key = (cohort_id, limit)
+        if key not in self.sent:
+            rank_list = await fetchTopRankList(cohort_id, limit)
+            # Kept when another client of the same board got there first.
+            self.sent.setdefault(key, rank_list)
+        queue = asyncio.Queue(maxsize=settings.SCOREBOARD_LIVE_QUEUE_SIZE)
+        queue.put_nowait(sseEvent(b'snapshot', renderScoreboard(self.sent[key])))
+        self.subscribers.setdefault(cohort_id, {}).setdefault(limit, set()).add(queue)
+        self.countClients()
+        if self.ticker is None or self.ticker.done():
+            self.ticker = loop.create_task(self.tick())
+        return queue
+
+    def unsubscribe(self, cohort_id, limit, queue):
+        limits = self.subscribers.get(cohort_id, {})
+        queues = limits.get(limit, set())
+        queues.discard(queue)
+        if not queues:
+            limits.pop(limit, None)
+            self.sent.pop((cohort_id, limit), None)
+        if not limits:
+            self.subscribers.pop(cohort_id, None)
+            self.dirty.discard(cohort_id)
+        self.countClients()
+        if not self.subscribers and self.ticker is not None:
+            self.ticker.cancel()
+            self.ticker = None
+
+    async def tick(self):
+        while self.subscribers:
+            await asyncio.sleep(settings.SCOREBOARD_LIVE_INTERVAL)
+            dirty, self.dirty = self.dirty, set()
+            results = await asyncio.gather(*(self.push(cohort_id) for cohort_id in dirty), return_exceptions=True)
+            for cohort_id, result in zip(dirty, results):
+                if isinstance(result, Exception):
+                    logger.error("Live board of cohort %s not pushed", cohort_id, exc_info=result)
+
+    async def push(self, cohort_id):
+        """
+        Read the top of the cohort once for all its clients and queue their diffs.
+        """
+        limits = self.subscribers.get(cohort_id)
+        if not limits:
+            return
+        fetched = max(limits)
+        top = await fetchTopRankList(cohort_id, fetched)
+        for limit, queues in list(self.subscribers.get(cohort_id, {}).items()):
+            if limit > fetched:
+                # Joined during the read, it is diffed on the next tick.
+                self.dirty.add(cohort_id)
+                continue
+            rank_list = top[:limit]
+            diff = diffRankLists(self.sent[(cohort_id, limit)], rank_list)
+            if diff is None:
+                continue
+            self.sent[(cohort_id, limit)] = rank_list
+            event = sseEvent(b'diff', json.dumps(diff).encode())
+            snapshot = None
+            for queue in queues:
+                try:
+                    queue.put_nowait(event)
+                except asyncio.QueueFull:
+                    # A client too slow for the diffs starts over from the current top.
+                    snapshot = snapshot or sseEvent(b'snapshot', renderScoreboard(rank_list))
+                    while not queue.empty():
+                        queue.get_nowait()
+                    queue.put_nowait(snapshot)
+
+
+live_scoreboards = LiveScoreboards()
+
+async def sendResponse(send, status, body, content_type=b'application/json'):
+    await send({'type': 'http.response.start', 'status': status, 'headers': [(b'content-type', content_type)]})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def waitForDisconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+async def streamLiveScoreboard(cohort_id, scope, receive, send):
+    """
+    Stream the top `limit` of the cohort until the client goes away, with a keepalive
+    comment after SCOREBOARD_LIVE_KEEPALIVE seconds without an event.
+    """
+    if scope['method'] != 'GET':
+        return await sendResponse(send, 405, b'')
+    params = LiveScoreboardSerializer(data=QueryDict(scope['query_string'].decode('latin-1')))
+    if not params.is_valid():
+        return await sendResponse(send, 400, json.dumps(params.errors).encode())
+    limit = params.validated_data['limit']
+    queue = await live_scoreboards.subscribe(cohort_id, limit)
+    disconnected = asyncio.ensure_future(waitForDisconnect(receive))
+    next_event = None
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            # Proxies would otherwise hold the events back.
+            (b'x-accel-buffering', b'no'),
+        ]})
+        while True:
+            next_event = next_event or asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait(
+                {next_event, disconnected}, timeout=settings.SCOREBOARD_LIVE_KEEPALIVE,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            if disconnected in done:
+                break
+            if next_event in done:
+                body, next_event = next_event.result(), None
+            else:
+                body = KEEPALIVE_EVENT
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+    finally:
+        disconnected.cancel()
+        if next_event is not None:
+            next_event.cancel()
+        live_scoreboards.unsubscribe(cohort_id, limit, queue)
+
+
+class LiveScoreboardRouter:
+    """
+    ASGI app streaming live boards itself and passing every other request to `application`.
+    Django 4.1 cannot stream from async code, so live boards do not go through a view.
+    """
+
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        match = LIVE_PATH.match(scope['path']) if scope['type'] == 'http' else None
+        if match is None:
+            return await self.application(scope, receive, send)
+        await streamLiveScoreboard(int(match['cohort_id']), scope, receive, send)
@@ -0,0 +1,242 @@
+import json
+import random
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import RequestFactory
+
+from cohorts.models import Cohort, CohortUser
+from cohorts.scoreboard import FetchRankList, fetchRankListFromDB, updateUserRank
+from cohorts.views import CohortScoreBoard
+from commons.redis import loadRedisScripts, performRedisOps
+from users.models import User
+
+
+def percentile(timings, fraction):
+    """
+    Nearest rank percentile of a sorted list.
+    """
+    return timings[min(len(timings) - 1, max(0, round(fraction * len(timings)) - 1))]
+
+def summarize(members, scenario, timings, elapsed):
+    timings = sorted(timings)
+    return {
+        "members": members,
+        "scenario": scenario,
+        "samples": len(timings),
+        "p50_ms": round(percentile(timings, 0.5), 3),
+        "p99_ms": round(percentile(timings, 0.99), 3),
+        "max_ms": round(timings[-1], 3),
+        "ops_per_sec": round(len(timings) / elapsed, 1),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure scoreboard latency and throughput for synthetic cohorts of the given sizes. "
+        "Runs offline with DJANGO_SETTINGS_MODULE=scoareboard_caching.benchmark_settings and --fakeredis."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, nargs='+', default=[1000, 10000, 100000])
+        parser.add_argument('--repeat', type=int, default=20, help="Samples per latency scenario.")
+        parser.add_argument('--page-size', type=int, default=50)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--operations', type=int, default=2000, help="Operations of the mixed scenario.")
+        parser.add_argument('--threads', type=int, default=4, help="Concurrent clients of the mixed scenario.")
+        parser.add_argument('--write-ratio', type=float, default=0.1, help="Share of writes in the mixed scenario.")
+        parser.add_argument('--output', help="Write the results as JSON to this file.")
+        parser.add_argument('--compare', help="JSON results of an earlier run to compare p50/p99 against.")
+        parser.add_argument(
+            '--fakeredis', action='store_true',
+            help="Serve REDIS_URL from an in-process fakeredis server instead of a running redis."
+        )
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        fake_server = self.start_fakeredis() if options['fakeredis'] else None
+        try:
+            results = []
+            self.stdout.write(
+                f"{'members':>10} {'scenario':>12} {'p50 ms':>10} {'p99 ms':>10} {'max ms':>10} {'ops/s':>10}"
+            )
+            for members in options['members']:
+                cohort, user_ids = self.create_cohort(members)
+                try:
+                    for result in self.run_scenarios(cohort.id, user_ids, options):
+                        results.append(result)
+                        self.stdout.write(
+                            f"{members:>10} {result['scenario']:>12} {result['p50_ms']:>10.2f} "
+                            f"{result['p99_ms']:>10.2f} {result['max_ms']:>10.2f} {result['ops_per_sec']:>10.1f}"
+                        )
+                finally:
+                    self.clear_cache(cohort.id)
+                    self.delete_cohort(cohort)
+        finally:
+            if fake_server is not None:
+                fake_server.shutdown()
+                fake_server.server_close()
+
+        report = {"meta": self.describe_run(options), "results": results}
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+        if options['compare']:
+            self.compare(options['compare'], results)
+
+    def run_scenarios(self, cohort_id, user_ids, options):
+        page_size = options['page_size']
+        scoreboard = CohortScoreBoard.as_view()
+        factory = RequestFactory()
+
+        def readPage():
+            return FetchRankList(cohort_id, 0, page_size)
+
+        def writeScore():
+            user_id = random.choice(user_ids)
+            score = random.randint(0, 100000)
+            CohortUser.objects.filter(cohort_id=cohort_id, user_id=user_id).update(score=score)
+            updateUserRank(user_id, cohort_id, score)
+
+        latency_scenarios = [
+            ('db_page', lambda: list(fetchRankListFromDB(cohort_id, 0, page_size)), False),
+            ('cold_miss', readPage, True),
+            ('warm_hit', readPage, False),
+            ('endpoint_hit', lambda: scoreboard(factory.get('/', {'limit': page_size}), cohort_id=cohort_id), False),
+            ('update', lambda: updateUserRank(random.choice(user_ids), cohort_id, random.randint(0, 100000)), False),
+        ]
+        for scenario, operation, cold in latency_scenarios:
+            readPage()
+            timings = self.measure(cohort_id, operation, options['repeat'], cold)
+            yield summarize(len(user_ids), scenario, timings, sum(timings) / 1000)
+        readPage()
+        timings, elapsed = self.measure_mixed(readPage, writeScore, options)
+        yield summarize(len(user_ids), 'mixed', timings, elapsed)
+
+    def measure(self, cohort_id, operation, repeat, cold):
+        """
+        Time `operation` `repeat` times, on a cold board with `cold`. Returns the timings in ms.
+        """
+        timings = []
+        for _ in range(repeat):
+            if cold:
+                self.clear_cache(cohort_id)
+            started = time.perf_counter()
+            operation()
+            timings.append((time.perf_counter() - started) * 1000)
+        return timings
+
+    def measure_mixed(self, read, write, options):
+        """
+        Run --operations reads and writes from --threads clients.
+        Returns the timings in ms and the wall time in seconds.
+        """
+        plan = [random.random() < options['write_ratio'] for _ in range(options['operations'])]
+        lock = threading.Lock()
+        timings = []
+
+        def client(share):
+            try:
+                for is_write in share:
+                    started = time.perf_counter()
+                    if is_write:
+                        write()
+                    else:
+                        read()
+                    with lock:
+                        timings.append((time.perf_counter() - started) * 1000)
+            finally:
+                connection.close()
+
+        threads = options['threads']
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(client, [plan[i::threads] for i in range(threads)]))
+        return timings, time.perf_counter() - started
+
+    def create_cohort(self, members):
+        with transaction.atomic():
+            cohort = Cohort.objects.create(name=f'bench-{members}')
+            users = User.objects.bulk_create(
+                [User(email=f'bench-{cohort.id}-{i}@example.com') for i in range(members)],
+                batch_size=5000
+            )
+            if users[0].pk is None:
+                users = User.objects.filter(email__startswith=f'bench-{cohort.id}-')
+            CohortUser.objects.bulk_create(
+                [CohortUser(cohort=cohort, user=user, score=random.randint(0, 100000)) for user in users],
+                batch_size=5000
+            )
+        return cohort, [user.pk for user in users]
+
+    def delete_cohort(self, cohort):
+        with transaction.atomic():
+            User.objects.filter(email__startswith=f'bench-{cohort.id}-').delete()
+            cohort.delete()
+
+    def clear_cache(self, cohort_id):
+        performRedisOps(
+            "delete",
+            f'batch_rank_list:{cohort_id}.',
+            f'batch_rank_list_fresh:{cohort_id}.',
+            f'batch_rank_list_lock:{cohort_id}.',
+            f'batch_rank_snapshot:{cohort_id}.',
+            f'batch_user_email:{cohort_id}.',
+            cohort_id=cohort_id
+        )
+
+    def start_fakeredis(self):
+        try:
+            from fakeredis import TcpFakeServer
+        except ImportError:
+            raise CommandError("--fakeredis needs fakeredis[lua], see requirements-dev.txt.")
+        url = urlparse(settings.REDIS_URL)
+        try:
+            server = TcpFakeServer((url.hostname or 'localhost', url.port or 6379))
+        except OSError as error:
+            raise CommandError(f"Cannot serve fakeredis on {settings.REDIS_URL}: {error}")
+        threading.Thread(target=server.serve_forever, name='fakeredis', daemon=True).start()
+        # Scripts are loaded up front, so no call is answered with NOSCRIPT.
+        loadRedisScripts()
+        return server
+
+    def describe_run(self, options):
+        try:
+            commit = subprocess.run(
+                ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+        return {
+            "commit": commit,
+            "created": datetime.now(timezone.utc).isoformat(),
+            "database": connection.vendor,
+            "redis": 'fakeredis' if options['fakeredis'] else settings.REDIS_URL,
+            "options": {
+                name: options[name]
+                for name in ('members', 'repeat', 'page_size', 'seed', 'operations', 'threads', 'write_ratio')
+            },
+        }
+
+    def compare(self, baseline_path, results):
+        with open(baseline_path) as baseline_file:
+            baseline = {
+                (result['members'], result['scenario']): result for result in json.load(baseline_file)['results']
+            }
+        self.stdout.write(f"\n{'members':>10} {'scenario':>12} {'p50 change':>12} {'p99 change':>12}")
+        for result in results:
+            before = baseline.get((result['members'], result['scenario']))
+            if before is None:
+                continue
+            changes = [
+                f"{(result[key] / before[key] - 1) * 100:>+11.1f}%" if before[key] else f"{'n/a':>12}"
+                for key in ('p50_ms', 'p99_ms')
+            ]
+            self.stdout.write(f"{result['members']:>10} {result['scenario']:>12} {changes[0]} {changes[1]}")
@@ -0,0 +1,43 @@
+import os
+import signal
+import socket
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from cohorts.write_behind import ensureConsumerGroup, flushQueuedScoresOnce
+from commons.redis import redis_ring
+
+
+class Command(BaseCommand):
+    help = "Persist the scores queued in write behind mode to the DB, in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--consumer', default=f'{socket.gethostname()}-{os.getpid()}',
+            help="Consumer name in the group, reuse it after a restart to replay its unacked batches first."
+        )
+        parser.add_argument('--batch-size', type=int, default=settings.SCOREBOARD_WRITE_BEHIND_BATCH_SIZE)
+        parser.add_argument('--block-ms', type=int, default=settings.SCOREBOARD_WRITE_BEHIND_BLOCK_MS)
+        parser.add_argument('--once', action='store_true', help="Exit once the stream is drained.")
+
+    def handle(self, *args, **options):
+        stopping = []
+        # Finish the batch in flight before exiting.
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+        nodes = redis_ring.nodes
+        for node in nodes:
+            ensureConsumerGroup(node)
+        # The wait for new entries is shared by the streams of all the nodes, read in turn.
+        block_ms = None if options['once'] else max(1, options['block_ms'] // len(nodes))
+        flushed_entries = flushed_users = 0
+        while not stopping:
+            round_entries = 0
+            for node in nodes:
+                entries, users = flushQueuedScoresOnce(options['consumer'], options['batch_size'], block_ms, node)
+                round_entries += entries
+                flushed_entries += entries
+                flushed_users += users
+            if options['once'] and not round_entries:
+                break
+        self.stdout.write(f"Flushed {flushed_entries} updates to {flushed_users} cohort users.")
@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from cohorts.windows import pruneScoreEvents, windowBounds
+
+
+class Command(BaseCommand):
+    help = "Delete the score events older than the current weekly window, no board reads them anymore."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=settings.SCOREBOARD_UPDATE_CHUNK_SIZE, help="Events deleted per query."
+        )
+
+    def handle(self, *args, **options):
+        # The current day is always within the current week.
+        _, before, _ = windowBounds('weekly', timezone.now())
+        deleted = pruneScoreEvents(before, options['batch_size'])
+        self.stdout.write(f"Deleted {deleted} score events created before {before.isoformat()}.")
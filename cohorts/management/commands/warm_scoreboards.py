@@ -0,0 +1,88 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from cohorts.models import CohortUser
+from cohorts.scoreboard import carryPendingScores, dropRankLists, warmRankLists
+from commons.redis import HashRing, RedisNode, performShardedPipeline, redisNode
+
+
+class Command(BaseCommand):
+    help = (
+        "Build the cached boards of the given cohorts, or of every cohort with a score, "
+        "e.g. after a deploy, a redis failover or a change of REDIS_NODES."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('cohort_ids', type=int, nargs='*')
+        parser.add_argument('--chunk-size', type=int, default=2000, help="Rows fetched and written per round trip.")
+        parser.add_argument(
+            '--concurrency', type=int, default=1, help="Cohort groups warmed in parallel, one query each."
+        )
+        parser.add_argument(
+            '--max-rows-per-second', type=int, default=None, help="Read rate limit, shared by all groups."
+        )
+        parser.add_argument('--skip-cached', action='store_true', help="Leave cohorts with a cached board alone.")
+        parser.add_argument(
+            '--previous-nodes', nargs='+', metavar='URL',
+            help="REDIS_NODES before a change, only the cohorts moved to another node are warmed, "
+                 "along with their pending write behind scores."
+        )
+        parser.add_argument(
+            '--drop-moved', action='store_true', help="With --previous-nodes, delete the boards left on the old nodes."
+        )
+
+    def handle(self, *args, **options):
+        cohort_ids = options['cohort_ids'] or list(
+            CohortUser.objects.filter(score__gt=0).order_by('cohort_id').values_list('cohort_id', flat=True).distinct()
+        )
+        moved = {}
+        if options['previous_nodes']:
+            previous = HashRing([RedisNode(url) for url in options['previous_nodes']], settings.REDIS_RING_REPLICAS)
+            moved = {
+                cohort_id: previous.get(cohort_id) for cohort_id in cohort_ids
+                if previous.get(cohort_id).name != redisNode(cohort_id).name
+            }
+            cohort_ids = list(moved)
+            # Carried over first, so the warmed boards include them.
+            carried = carryPendingScores(moved)
+            self.stdout.write(f"{len(moved)} cohorts moved to another node, {carried} pending scores carried over.")
+        if options['skip_cached']:
+            cached = performShardedPipeline(
+                cohort_ids, lambda pipeline, cohort_id: pipeline.exists(f'batch_rank_list:{cohort_id}.')
+            )
+            cohort_ids = [cohort_id for cohort_id in cohort_ids if not cached[cohort_id][0]]
+        if not cohort_ids:
+            self.stdout.write("No cohort to warm.")
+            return
+
+        concurrency = max(1, min(options['concurrency'], len(cohort_ids)))
+        max_rows_per_second = options['max_rows_per_second'] and options['max_rows_per_second'] / concurrency
+
+        def warm(group):
+            # Cohorts a request is rebuilding are left to it.
+            return warmRankLists(group, options['chunk_size'], max_rows_per_second, lock=True)
+
+        def warmInThread(group):
+            try:
+                return warm(group)
+            finally:
+                connection.close()
+
+        started = time.monotonic()
+        if concurrency == 1:
+            groups = [warm(cohort_ids)]
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                groups = list(executor.map(warmInThread, [cohort_ids[i::concurrency] for i in range(concurrency)]))
+        warmed = {cohort_id: members for group in groups for cohort_id, members in group.items()}
+        self.stdout.write(
+            f"Warmed {len(warmed)} cohorts, {sum(warmed.values())} ranked members "
+            f"in {time.monotonic() - started:.2f}s, {len(cohort_ids) - len(warmed)} being rebuilt skipped."
+        )
+        if options['drop_moved'] and moved:
+            dropRankLists(moved)
+            self.stdout.write(f"Dropped the boards of {len(moved)} cohorts from their previous node.")
@@ -0,0 +1,21 @@
+# Generated by Django 4.1.3 on 2026-10-18 06:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cohorts', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cohortuser',
+            index=models.Index(fields=['cohort', 'score', 'user'], name='cohort_score_user_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='cohortuser',
+            constraint=models.UniqueConstraint(fields=('cohort', 'user'), name='unique_cohort_user'),
+        ),
+    ]
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.db import models
 from django.db.models.signals import post_save
 from django.dispatch import receiver
@@ -13,8 +14,43 @@ class CohortUser(models.Model):
     score = models.IntegerField()
     created_on = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['cohort', 'user'], name='unique_cohort_user'),
+        ]
+        indexes = [
+            # Covers the scoreboard queries, rank and ordering never touch the table rows.
+            models.Index(fields=['cohort', 'score', 'user'], name='cohort_score_user_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Score as last saved, to know the change made by the next save.
+        instance._saved_score = instance.__dict__.get('score')
+        return instance
+
+class ScoreEvent(models.Model):
+    """
+    Change of a cohort user's score, windowed boards are rebuilt from these.
+    """
+    cohort = models.ForeignKey(Cohort, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    delta = models.IntegerField()
+    created_on = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['cohort', 'created_on'], name='score_event_cohort_time_idx'),
+        ]
+
 @receiver(post_save, sender=CohortUser)
 def update_scoreboard(sender, instance, created, **kwargs):
     if not created:  
         from .scoreboard import updateUserRank
-        updateUserRank(instance.user.email, instance.cohort_id, instance.score)
+        updateUserRank(instance.user_id, instance.cohort_id, instance.score)
+        saved_score = getattr(instance, '_saved_score', None)
+        if settings.SCOREBOARD_WINDOWS_ENABLED and saved_score is not None and instance.score != saved_score:
+            from .windows import recordScoreDeltas
+            recordScoreDeltas(instance.cohort_id, {instance.user_id: instance.score - saved_score})
+    instance._saved_score = instance.score
@@ -1,27 +1,1101 @@
+import gzip
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Max, Q, Sum, Window
+from django.db.models.functions import RowNumber
+
 from cohorts.models import CohortUser
-from commons.redis import performRedisOps
-from commons.cost_tracker import track_db_hit
+from cohorts.serializer import renderScoreboard
+from users.models import User
+from commons.redis import (
+    EXTEND_LOCK_SCRIPT, RELEASE_LOCK_SCRIPT, REDIS_UNAVAILABLE_ERRORS, acquireLock, acquireLocks, performRedisOps,
+    performRedisPipeline, performRedisOpsAsync, performRedisScript, performRedisScriptAsync, performShardedPipeline,
+    redisNode, registerRedisScript, releaseLock, releaseLocks, subscribeRedisChannel
+)
+from commons.cost_tracker import track_cache_result, track_db_hit
+from commons.local_cache import LocalCache
+
+_refresh_executor = ThreadPoolExecutor(
+    max_workers=settings.SCOREBOARD_REFRESH_WORKERS,
+    thread_name_prefix='scoreboard-refresh',
+)
+
+# Pages served by this process, keyed by (cohort_id, offset, limit).
+local_rank_lists = LocalCache(
+    max_entries=settings.SCOREBOARD_LOCAL_CACHE_MAX_ENTRIES,
+    ttl=settings.SCOREBOARD_LOCAL_CACHE_TTL,
+)
+# Reads served from the DB while redis is unavailable, pages keyed by (cohort_id, offset,
+# limit), other reads by a tuple starting with their kind.
+degraded_rank_lists = LocalCache(
+    max_entries=settings.SCOREBOARD_DEGRADED_CACHE_MAX_ENTRIES,
+    ttl=settings.SCOREBOARD_DEGRADED_CACHE_TTL,
+)
+# A page is read by one request at a time, striped over a fixed set of locks.
+_degraded_locks = [threading.Lock() for _ in range(64)]
+_invalidation_listener = None
+_invalidation_listener_lock = threading.Lock()
+
+def toMember(user_id):
+    """
+    Board members are zero padded user ids, so score writes never need the email and
+    ZREVRANGE breaks score ties by user id descending, same as the DB queries.
+    """
+    return f'{int(user_id):012d}'
+
+# Emails are kept in a per cohort hash next to the board, a missing one is nil.
+RESOLVE_EMAILS_LUA = """
+local function resolveEmails(emails_key, range)
+    local emails = {}
+    for i = 1, #range, 2 do
+        emails[#emails + 1] = redis.call('hget', emails_key, range[i])
+    end
+    return emails
+end
+"""
+
+# Returns nil when the board is missing, else
+# {is_fresh, flat member/score range, emails, board ttl in ms, board version}.
+READ_RANK_LIST_SCRIPT = registerRedisScript(RESOLVE_EMAILS_LUA + """
+if redis.call('exists', KEYS[1]) == 0 then
+    return false
+end
+local fresh = redis.call('exists', KEYS[2])
+local range = redis.call('zrevrange', KEYS[1], ARGV[1], ARGV[2], 'WITHSCORES')
+return {fresh, range, resolveEmails(KEYS[3], range), redis.call('pttl', KEYS[1]), redis.call('get', KEYS[4])}
+""")
+
+# Returns the board version KEYS[2], nil when board KEYS[1] is missing: the version key
+# outlives the board, and an expired board may no longer match the DB.
+READ_RANK_LIST_VERSION_SCRIPT = registerRedisScript("""
+if redis.call('exists', KEYS[1]) == 0 then
+    return false
+end
+return redis.call('get', KEYS[2])
+""")
+
+# Returns nil when the board is missing, -1 when the member is not ranked,
+# else {rank, window_start, flat member/score window, emails}.
+READ_USER_RANK_SCRIPT = registerRedisScript(RESOLVE_EMAILS_LUA + """
+if redis.call('exists', KEYS[1]) == 0 then
+    return false
+end
+local rank = redis.call('zrevrank', KEYS[1], ARGV[1])
+if not rank then
+    return -1
+end
+local start = math.max(rank - tonumber(ARGV[2]), 0)
+local window = redis.call('zrevrange', KEYS[1], start, rank + tonumber(ARGV[2]), 'WITHSCORES')
+return {rank, start, window, resolveEmails(KEYS[2], window)}
+""")
+
+# Bumps the board version KEYS[2] (seeded with ARGV[3]), drops the rendered snapshots
+# KEYS[3] and announces the update of cohort ARGV[2] on channel ARGV[1]. Then applies
+# the following score/member pairs only when the board is cached, returns nil otherwise.
+# Members without a positive score are dropped, same as the DB query.
+UPDATE_RANK_LIST_SCRIPT = registerRedisScript("""
+if not redis.call('set', KEYS[2], ARGV[3], 'NX') then
+    redis.call('incr', KEYS[2])
+end
+redis.call('del', KEYS[3])
+redis.call('publish', ARGV[1], ARGV[2])
+if redis.call('exists', KEYS[1]) == 0 then
+    return false
+end
+for i = 4, #ARGV, 2 do
+    if tonumber(ARGV[i]) > 0 then
+        redis.call('zadd', KEYS[1], ARGV[i], ARGV[i + 1])
+    else
+        redis.call('zrem', KEYS[1], ARGV[i + 1])
+    end
+end
+return 1
+""")
+
+# Stores snapshot ARGV[3] of page ARGV[1] in hash KEYS[1] only while the board is still at
+# version ARGV[2], so a snapshot rendered before a concurrent update is never kept.
+# The hash lives no longer than KEYS[3], the fresh marker or board it was rendered from.
+STORE_SNAPSHOT_SCRIPT = registerRedisScript("""
+if redis.call('get', KEYS[2]) ~= ARGV[2] then
+    return 0
+end
+local ttl = redis.call('pttl', KEYS[3])
+if ttl <= 0 then
+    return 0
+end
+redis.call('hset', KEYS[1], ARGV[1], ARGV[3])
+redis.call('pexpire', KEYS[1], ttl)
+return 1
+""")
+
+# Puts the scores of hash KEYS[2], written behind and not in the DB yet, on board KEYS[1]
+# and gives the board a ttl of ARGV[1] seconds if it had none.
+APPLY_PENDING_SCORES_SCRIPT = registerRedisScript("""
+local pending = redis.call('hgetall', KEYS[2])
+for i = 1, #pending, 2 do
+    if tonumber(pending[i + 1]) > 0 then
+        redis.call('zadd', KEYS[1], pending[i + 1], pending[i])
+    else
+        redis.call('zrem', KEYS[1], pending[i])
+    end
+end
+if redis.call('pttl', KEYS[1]) == -1 then
+    redis.call('expire', KEYS[1], ARGV[1])
+end
+return #pending / 2
+""")
+
+# Adds the member/score pairs of ARGV[2..] not already pending to hash KEYS[1], each with
+# an update of cohort ARGV[1] on write behind stream KEYS[2] for the flusher to persist it.
+CARRY_PENDING_SCORES_SCRIPT = registerRedisScript("""
+local carried = 0
+for i = 2, #ARGV, 2 do
+    if redis.call('hsetnx', KEYS[1], ARGV[i], ARGV[i + 1]) == 1 then
+        redis.call('xadd', KEYS[2], '*', 'cohort_id', ARGV[1], 'user_id', tonumber(ARGV[i]))
+        carried = carried + 1
+    end
+end
+return carried
+""")
 
-def fetchRankListFromDB(cohort_id):
+# Unions the N = ARGV[1] boards KEYS[3..N+2] into KEYS[1] with aggregate ARGV[2] and records
+# the versions KEYS[N+3..] in KEYS[2]. Both live as long as the shortest lived board, at
+# most ARGV[3] ms. Returns that ttl.
+BUILD_AGGREGATE_SCRIPT = registerRedisScript("""
+local n = tonumber(ARGV[1])
+local args, versions, ttl = {KEYS[1], n}, {}, tonumber(ARGV[3])
+for i = 1, n do
+    args[#args + 1] = KEYS[2 + i]
+    local board_ttl = redis.call('pttl', KEYS[2 + i])
+    if board_ttl > 0 and board_ttl < ttl then
+        ttl = board_ttl
+    end
+end
+for i = n + 3, #KEYS do
+    versions[#versions + 1] = redis.call('get', KEYS[i]) or ''
+end
+args[#args + 1] = 'AGGREGATE'
+args[#args + 1] = ARGV[2]
+if redis.call('zunionstore', unpack(args)) > 0 then
+    redis.call('pexpire', KEYS[1], ttl)
+end
+redis.call('set', KEYS[2], table.concat(versions, ','), 'PX', ttl)
+return ttl
+""")
+
+# Returns nil when the union KEYS[1] is missing or, unless ARGV[4] is 0, older than one of
+# the N = ARGV[1] boards it was built from, going by the versions KEYS[3..N+2] recorded in
+# KEYS[2]. Else {flat member/score range, emails, ttl in ms} of ranks ARGV[2] to ARGV[3],
+# emails are looked up in KEYS[N+3..2N+2] in turn.
+READ_AGGREGATE_SCRIPT = registerRedisScript("""
+local n = tonumber(ARGV[1])
+local built = redis.call('get', KEYS[2])
+if not built then
+    return false
+end
+local versions = {}
+for i = 1, n do
+    versions[i] = redis.call('get', KEYS[2 + i]) or ''
+end
+if ARGV[4] ~= '0' and table.concat(versions, ',') ~= built then
+    return false
+end
+local range = redis.call('zrevrange', KEYS[1], ARGV[2], ARGV[3], 'WITHSCORES')
+local emails = {}
+for i = 1, #range, 2 do
+    local email = false
+    for j = 1, n do
+        email = redis.call('hget', KEYS[2 + n + j], range[i])
+        if email then
+            break
+        end
+    end
+    emails[#emails + 1] = email
+end
+return {range, emails, redis.call('pttl', KEYS[2])}
+""")
+
+def versionSeed():
+    """
+    Versions start from the current time, so a flushed redis never hands out a
+    version a client may still hold for older data.
+    """
+    return time.time_ns() // 1000
+
+def getRankListVersion(cohort_id):
+    """
+    Version of the cached board, None when there is no board to compare an ETag against.
+    """
+    SCORE_BOARD_KEY = f'batch_rank_list:{cohort_id}.'
+    VERSION_KEY = f'batch_rank_version:{cohort_id}.'
+    try:
+        return performRedisScript(READ_RANK_LIST_VERSION_SCRIPT, [SCORE_BOARD_KEY, VERSION_KEY], cohort_id=cohort_id)
+    except REDIS_UNAVAILABLE_ERRORS:
+        return None
+
+async def getRankListVersionAsync(cohort_id):
+    SCORE_BOARD_KEY = f'batch_rank_list:{cohort_id}.'
+    VERSION_KEY = f'batch_rank_version:{cohort_id}.'
+    try:
+        return await performRedisScriptAsync(
+            READ_RANK_LIST_VERSION_SCRIPT, [SCORE_BOARD_KEY, VERSION_KEY], cohort_id=cohort_id
+        )
+    except REDIS_UNAVAILABLE_ERRORS:
+        return None
+
+def resolveUserEmails(cohort_id, user_ids):
+    EMAILS_KEY = f'batch_user_email:{cohort_id}.'
     track_db_hit()
-    return CohortUser.objects.filter(
+    emails = dict(User.objects.filter(id__in=user_ids).values_list('id', 'email'))
+    if emails:
+        try:
+            performRedisPipeline(lambda pipeline: pipeline.hset(
+                EMAILS_KEY, mapping={toMember(user_id): email for user_id, email in emails.items()}
+            ).expire(EMAILS_KEY, getCacheTTL(cohort_id)[1]), cohort_id=cohort_id)
+        except REDIS_UNAVAILABLE_ERRORS:
+            # Only a cache, the emails are still served.
+            pass
+    return emails
+
+def toRankList(cohort_id, flat_range, emails):
+    user_ids = [int(member) for member in flat_range[::2]]
+    missing = [user_id for user_id, email in zip(user_ids, emails) if email is None]
+    resolved = resolveUserEmails(cohort_id, missing) if missing else {}
+    return [
+        (resolved.get(user_id) if email is None else email, int(float(score)))
+        for user_id, email, score in zip(user_ids, emails, flat_range[1::2])
+    ]
+
+def fetchRankListFromDB(cohort_id, offset=0, limit=None):
+    track_db_hit()
+    cohort_users = CohortUser.objects.filter(
         score__gt=0,
         cohort_id=cohort_id
-    ).order_by('-score').values_list('user__email', 'score')
+    ).order_by('-score', '-user_id').values_list('user__email', 'score')
+    if limit is None:
+        return cohort_users[offset:]
+    return cohort_users[offset:offset + limit]
 
-def FetchRankList(cohort_id):
+def fetchCohortMembersFromDB(cohort_id):
+    track_db_hit()
+    return CohortUser.objects.filter(cohort_id=cohort_id).values_list('user_id', 'user__email', 'score')
+
+def getCacheTTL(cohort_id):
+    """
+    Returns (soft_ttl, hard_ttl) for the cohort board, soft_ttl is None when
+    stale-while-revalidate is disabled.
+    """
+    cohort_ttl = settings.SCOREBOARD_COHORT_CACHE_TTL.get(cohort_id, {})
+    return (
+        cohort_ttl.get('soft', settings.SCOREBOARD_CACHE_SOFT_TTL),
+        cohort_ttl.get('hard', settings.SCOREBOARD_CACHE_TTL),
+    )
+
+def queueVersionBump(pipeline, cohort_id):
+    """
+    Queue the two commands bumping the board version, the second replies with it.
+    """
+    VERSION_KEY = f'batch_rank_version:{cohort_id}.'
+    pipeline.set(VERSION_KEY, versionSeed(), nx=True)
+    pipeline.incr(VERSION_KEY)
+
+def buildKeys(cohort_id):
+    """
+    Tmp keys of a new build of the board and email hash, unique to the build so
+    concurrent builds of a cohort never write into each other's keys.
+    """
+    build_id = uuid.uuid4().hex
+    return f'batch_rank_list_tmp:{cohort_id}:{build_id}.', f'batch_user_email_tmp:{cohort_id}:{build_id}.'
+
+def queueRankListSwap(pipeline, cohort_id, tmp_keys, has_scores, has_emails):
+    """
+    Queue the commands making the board and email hash built aside in their `tmp_keys`
+    live, so readers never see a half written board, and announce the new board.
+    """
     SCORE_BOARD_KEY = f'batch_rank_list:{cohort_id}.'
-    if performRedisOps("exists", SCORE_BOARD_KEY):
-        return performRedisOps("zrevrange", SCORE_BOARD_KEY, "0", "-1", "WITHSCORES")
+    EMAILS_KEY = f'batch_user_email:{cohort_id}.'
+    SCORE_BOARD_TMP_KEY, EMAILS_TMP_KEY = tmp_keys
+    FRESH_KEY = f'batch_rank_list_fresh:{cohort_id}.'
+    SNAPSHOT_KEY = f'batch_rank_snapshot:{cohort_id}.'
+    soft_ttl, hard_ttl = getCacheTTL(cohort_id)
+    pipeline.delete(SNAPSHOT_KEY)
+    if has_scores:
+        pipeline.rename(SCORE_BOARD_TMP_KEY, SCORE_BOARD_KEY)
+        pipeline.expire(SCORE_BOARD_KEY, hard_ttl)
     else:
-        cohort_users = fetchRankListFromDB(cohort_id)
-        score_list = {cohort_user[0]: cohort_user[1] for cohort_user in cohort_users}
+        pipeline.delete(SCORE_BOARD_KEY)
+    if has_emails:
+        pipeline.rename(EMAILS_TMP_KEY, EMAILS_KEY)
+        pipeline.expire(EMAILS_KEY, hard_ttl)
+    if settings.SCOREBOARD_WRITE_BEHIND_ENABLED:
+        PENDING_SCORES_KEY = f'batch_pending_scores:{cohort_id}.'
+        APPLY_PENDING_SCORES_SCRIPT(keys=[SCORE_BOARD_KEY, PENDING_SCORES_KEY], args=[hard_ttl], client=pipeline)
+    if soft_ttl is not None:
+        pipeline.set(FRESH_KEY, 1, ex=soft_ttl)
+    pipeline.publish(settings.SCOREBOARD_UPDATES_CHANNEL, cohort_id)
+
+def rebuildRankList(cohort_id):
+    """
+    Rebuild the cached board and email hash of the cohort, returns the full ranklist
+    and the new board version. Emails of members without a score are cached too, so
+    they can join the board later without a DB lookup.
+    """
+    SCORE_BOARD_TMP_KEY, EMAILS_TMP_KEY = tmp_keys = buildKeys(cohort_id)
+    PENDING_SCORES_KEY = f'batch_pending_scores:{cohort_id}.'
+    cohort_members = list(fetchCohortMembersFromDB(cohort_id))
+    score_list = {toMember(user_id): score for user_id, _, score in cohort_members if score > 0}
+    email_list = {toMember(user_id): email for user_id, email, _ in cohort_members}
+
+    def build(pipeline):
+        queueVersionBump(pipeline, cohort_id)
         if score_list:
-            performRedisOps("zadd", SCORE_BOARD_KEY, score_list)
-            performRedisOps('expire', SCORE_BOARD_KEY, 30)
-        return cohort_users
+            pipeline.zadd(SCORE_BOARD_TMP_KEY, score_list)
+        if email_list:
+            pipeline.hset(EMAILS_TMP_KEY, mapping=email_list)
+        queueRankListSwap(pipeline, cohort_id, tmp_keys, bool(score_list), bool(email_list))
+        pipeline.hgetall(PENDING_SCORES_KEY)
+
+    results = performRedisPipeline(build, cohort_id=cohort_id)
+    version = results[1]
+    pending = {int(member): int(score) for member, score in results[-1].items()}
+    rank_list = sorted(
+        (
+            (pending.get(user_id, score), user_id, email)
+            for user_id, email, score in cohort_members if pending.get(user_id, score) > 0
+        ),
+        reverse=True
+    )
+    return [(email, score) for score, _, email in rank_list], str(version)
+
+def fetchScoredMembersFromDB(cohort_ids):
+    track_db_hit()
+    return CohortUser.objects.filter(
+        score__gt=0,
+        cohort_id__in=cohort_ids
+    ).order_by('cohort_id').values_list('cohort_id', 'user_id', 'user__email', 'score')
+
+def warmRankLists(cohort_ids, chunk_size, max_rows_per_second=None, lock=False):
+    """
+    Build the boards of many cohorts from a single streamed query, `chunk_size` rows per
+    pipeline, reading at most `max_rows_per_second` rows. Returns {cohort_id: members}.
+    Only ranked members get their email cached, the others are looked up when they score.
+    With `lock`, a cohort is built under its rebuild lock, taken when its rows start and
+    refreshed with every chunk, and cohorts a request is rebuilding are left out.
+    """
+    warmed = dict.fromkeys(cohort_ids, 0)
+    tmp_keys = {cohort_id: buildKeys(cohort_id) for cohort_id in cohort_ids}
+    lock_keys = {cohort_id: f'batch_rank_list_lock:{cohort_id}.' for cohort_id in cohort_ids}
+    lock_timeout_ms = int(settings.SCOREBOARD_REBUILD_LOCK_TIMEOUT * 1000)
+    tokens = {}
+    reading = current = None
+    score_list, email_list = {}, {}
+
+    def flush(finished):
+        def build(pipeline, cohort_id):
+            SCORE_BOARD_TMP_KEY, EMAILS_TMP_KEY = tmp_keys[cohort_id]
+            if cohort_id == current and score_list:
+                # Keys of an interrupted warm expire instead of lingering.
+                pipeline.zadd(SCORE_BOARD_TMP_KEY, score_list)
+                pipeline.expire(SCORE_BOARD_TMP_KEY, settings.SCOREBOARD_BUILD_TTL)
+                pipeline.hset(EMAILS_TMP_KEY, mapping=email_list)
+                pipeline.expire(EMAILS_TMP_KEY, settings.SCOREBOARD_BUILD_TTL)
+            if cohort_id in finished:
+                queueVersionBump(pipeline, cohort_id)
+                ranked = warmed[cohort_id] > 0
+                queueRankListSwap(pipeline, cohort_id, tmp_keys[cohort_id], ranked, ranked)
+            if cohort_id in tokens and cohort_id in finished:
+                RELEASE_LOCK_SCRIPT(keys=[lock_keys[cohort_id]], args=[tokens[cohort_id]], client=pipeline)
+            elif cohort_id in tokens:
+                EXTEND_LOCK_SCRIPT(
+                    keys=[lock_keys[cohort_id]], args=[tokens[cohort_id], lock_timeout_ms], client=pipeline
+                )
+        flushed = [cohort_id for cohort_id in dict.fromkeys([current, *finished]) if cohort_id is not None]
+        performShardedPipeline(flushed, build)
+        for cohort_id in finished:
+            tokens.pop(cohort_id, None)
+        score_list.clear()
+        email_list.clear()
+
+    def start(cohort_id):
+        if lock:
+            token = acquireLock(lock_keys[cohort_id], settings.SCOREBOARD_REBUILD_LOCK_TIMEOUT, cohort_id=cohort_id)
+            if token is None:
+                del warmed[cohort_id]
+                return None
+            tokens[cohort_id] = token
+        return cohort_id
+
+    started = time.monotonic()
+    rows = fetchScoredMembersFromDB(cohort_ids).iterator(chunk_size=chunk_size)
+    try:
+        for done, (cohort_id, user_id, email, score) in enumerate(rows, 1):
+            if cohort_id != reading:
+                if current is not None:
+                    flush([current])
+                reading, current = cohort_id, start(cohort_id)
+            if current is not None:
+                score_list[toMember(user_id)] = score
+                email_list[toMember(user_id)] = email
+                warmed[cohort_id] += 1
+            if done % chunk_size == 0:
+                flush([])
+                if max_rows_per_second:
+                    time.sleep(max(0, started + done / max_rows_per_second - time.monotonic()))
+        if current is not None:
+            flush([current])
+            current = None
+        unranked = [cohort_id for cohort_id, members in warmed.items() if not members]
+        if lock and unranked:
+            tokens.update(acquireLocks(
+                {cohort_id: lock_keys[cohort_id] for cohort_id in unranked}, settings.SCOREBOARD_REBUILD_LOCK_TIMEOUT
+            ))
+            for cohort_id in unranked:
+                if cohort_id not in tokens:
+                    del warmed[cohort_id]
+            unranked = [cohort_id for cohort_id in unranked if cohort_id in tokens]
+        if unranked:
+            flush(unranked)
+    finally:
+        # Left by an interrupted warm.
+        if tokens:
+            releaseLocks(lock_keys, tokens)
+    return warmed
+
+def rankListKeys(cohort_id):
+    return [
+        f'batch_rank_list:{cohort_id}.',
+        f'batch_rank_list_fresh:{cohort_id}.',
+        f'batch_user_email:{cohort_id}.',
+        f'batch_rank_version:{cohort_id}.',
+        f'batch_rank_snapshot:{cohort_id}.',
+        f'batch_pending_scores:{cohort_id}.',
+    ]
+
+def carryPendingScores(moved):
+    """
+    Copy the write behind scores pending on the previous node of the cohorts
+    {cohort_id: previous node} to their current node, with one pipeline per node.
+    Returns the number of scores carried over.
+    """
+    by_node = {}
+    for cohort_id, node in moved.items():
+        by_node.setdefault(node, []).append(cohort_id)
+    pending = {}
+    for node, cohort_ids in by_node.items():
+        replies = performRedisPipeline(lambda pipeline: [
+            pipeline.hgetall(f'batch_pending_scores:{cohort_id}.') for cohort_id in cohort_ids
+        ], transaction=False, node=node)
+        pending.update((cohort_id, scores) for cohort_id, scores in zip(cohort_ids, replies) if scores)
+    carried = performShardedPipeline(pending, lambda pipeline, cohort_id: CARRY_PENDING_SCORES_SCRIPT(
+        keys=[f'batch_pending_scores:{cohort_id}.', settings.SCOREBOARD_WRITE_BEHIND_STREAM],
+        args=[cohort_id, *[item for member_score in pending[cohort_id].items() for item in member_score]],
+        client=pipeline
+    ))
+    return sum(count for count, in carried.values())
+
+def dropRankLists(moved):
+    """
+    Delete the cached boards left on the previous node of the cohorts {cohort_id: previous node}.
+    """
+    by_node = {}
+    for cohort_id, node in moved.items():
+        by_node.setdefault(node, []).extend(rankListKeys(cohort_id))
+    for node, keys in by_node.items():
+        performRedisOps("delete", *keys, node=node)
+
+def refreshRankList(cohort_id, token):
+    REBUILD_LOCK_KEY = f'batch_rank_list_lock:{cohort_id}.'
+    try:
+        rebuildRankList(cohort_id)
+    finally:
+        releaseLock(REBUILD_LOCK_KEY, token, cohort_id=cohort_id)
+        connection.close()
+
+def scheduleRankListRefresh(cohort_id):
+    REBUILD_LOCK_KEY = f'batch_rank_list_lock:{cohort_id}.'
+    token = acquireLock(REBUILD_LOCK_KEY, settings.SCOREBOARD_REBUILD_LOCK_TIMEOUT, cohort_id=cohort_id)
+    if token is not None:
+        return _refresh_executor.submit(refreshRankList, cohort_id, token)
+    return None
+
+def warmLockedRankLists(lock_keys, tokens):
+    try:
+        warmRankLists(list(tokens), settings.SCOREBOARD_UPDATE_CHUNK_SIZE)
+    finally:
+        releaseLocks(lock_keys, tokens)
+        connection.close()
+
+def scheduleRankListsWarm(cohort_ids):
+    """
+    Rebuild the boards of the cohorts no one else is rebuilding with one background warm.
+    """
+    lock_keys = {cohort_id: f'batch_rank_list_lock:{cohort_id}.' for cohort_id in cohort_ids}
+    tokens = acquireLocks(lock_keys, settings.SCOREBOARD_REBUILD_LOCK_TIMEOUT)
+    if tokens:
+        return _refresh_executor.submit(warmLockedRankLists, lock_keys, tokens)
+    return None
+
+def invalidateLocalRankLists(cohort_id):
+    local_rank_lists.invalidate(lambda key: key[0] == cohort_id)
+
+def ensureInvalidationListener():
+    global _invalidation_listener
+    with _invalidation_listener_lock:
+        if _invalidation_listener is None:
+            _invalidation_listener = subscribeRedisChannel(
+                settings.SCOREBOARD_UPDATES_CHANNEL,
+                lambda cohort_id: invalidateLocalRankLists(int(cohort_id)),
+                on_reconnect=local_rank_lists.clear,
+            )
 
-def updateUserRank(user_email, cohort_id, new_score):
+def loadRankList(cohort_id, offset=0, limit=None):
+    """
+    Returns (rank_list, ttl, version) where ttl is how many more seconds the rank list
+    may be served and version identifies the board it was read from, None if unknown.
+    """
     SCORE_BOARD_KEY = f'batch_rank_list:{cohort_id}.'
-    if performRedisOps("exists", SCORE_BOARD_KEY):
-        performRedisOps("zadd", SCORE_BOARD_KEY, {user_email: new_score})
+    REBUILD_LOCK_KEY = f'batch_rank_list_lock:{cohort_id}.'
+    FRESH_KEY = f'batch_rank_list_fresh:{cohort_id}.'
+    EMAILS_KEY = f'batch_user_email:{cohort_id}.'
+    VERSION_KEY = f'batch_rank_version:{cohort_id}.'
+    deadline = time.monotonic() + settings.SCOREBOARD_REBUILD_WAIT_TIMEOUT
+    while True:
+        stop = -1 if limit is None else offset + limit - 1
+        cached = performRedisScript(
+            READ_RANK_LIST_SCRIPT, [SCORE_BOARD_KEY, FRESH_KEY, EMAILS_KEY, VERSION_KEY], [offset, stop],
+            cohort_id=cohort_id
+        )
+        if cached is not None:
+            is_fresh, rank_list, emails, ttl, version = cached
+            if not is_fresh and getCacheTTL(cohort_id)[0] is not None:
+                track_cache_result("stale")
+                scheduleRankListRefresh(cohort_id)
+            else:
+                track_cache_result("hit")
+            return toRankList(cohort_id, rank_list, emails), ttl / 1000, version
+        token = acquireLock(REBUILD_LOCK_KEY, settings.SCOREBOARD_REBUILD_LOCK_TIMEOUT, cohort_id=cohort_id)
+        if token is not None:
+            try:
+                # Board may have been rebuilt between the exists check and taking the lock.
+                if performRedisOps("exists", SCORE_BOARD_KEY, cohort_id=cohort_id):
+                    continue
+                # The cache is rebuilt from the whole board, only the requested window is returned.
+                track_cache_result("miss")
+                cohort_users, version = rebuildRankList(cohort_id)
+            finally:
+                releaseLock(REBUILD_LOCK_KEY, token, cohort_id=cohort_id)
+            stop = None if limit is None else offset + limit
+            return cohort_users[offset:stop], getCacheTTL(cohort_id)[1], version
+        if time.monotonic() >= deadline:
+            track_cache_result("miss")
+            return list(fetchRankListFromDB(cohort_id, offset, limit)), 0, None
+        time.sleep(settings.SCOREBOARD_REBUILD_POLL_INTERVAL)
+
+def fetchDegraded(key, fetch):
+    """
+    Result of the DB read `fetch()` while redis is unavailable. Results are kept in process
+    for SCOREBOARD_DEGRADED_CACHE_TTL seconds, so an outage costs each process one query
+    per `key` and TTL rather than one per request.
+    """
+    # Kept boxed, so a None result is cached too.
+    cached = degraded_rank_lists.get(key)
+    if cached is None:
+        with _degraded_locks[hash(key) % len(_degraded_locks)]:
+            cached = degraded_rank_lists.get(key)
+            if cached is None:
+                track_cache_result("miss")
+                result = fetch()
+                degraded_rank_lists.set(key, (result,))
+                return result
+    track_cache_result("local")
+    return cached[0]
+
+def fetchDegradedRankList(cohort_id, offset=0, limit=None):
+    return fetchDegraded((cohort_id, offset, limit), lambda: tuple(fetchRankListFromDB(cohort_id, offset, limit)))
+
+def FetchRankListPage(cohort_id, offset=0, limit=None):
+    """
+    Returns (rank_list, version) of the requested window of the ranklist, version is
+    None when redis is unavailable.
+    """
+    try:
+        if not settings.SCOREBOARD_LOCAL_CACHE_ENABLED:
+            return loadRankList(cohort_id, offset, limit)[::2]
+        ensureInvalidationListener()
+        page = local_rank_lists.get((cohort_id, offset, limit))
+        if page is not None:
+            track_cache_result("local")
+        else:
+            rank_list, ttl, version = loadRankList(cohort_id, offset, limit)
+            page = (tuple(rank_list), version)
+            local_rank_lists.set((cohort_id, offset, limit), page, ttl)
+        return page
+    except REDIS_UNAVAILABLE_ERRORS:
+        return fetchDegradedRankList(cohort_id, offset, limit), None
+
+def FetchRankList(cohort_id, offset=0, limit=None):
+    return FetchRankListPage(cohort_id, offset, limit)[0]
+
+def fetchTopRankListsFromDB(cohort_ids, limit):
+    """
+    Returns {cohort_id: top `limit` ranklist} of the cohorts from a single query.
+    """
+    track_db_hit()
+    ranked = CohortUser.objects.filter(
+        score__gt=0,
+        cohort_id__in=cohort_ids
+    ).annotate(board_rank=Window(
+        expression=RowNumber(),
+        partition_by=[F('cohort_id')],
+        order_by=[F('score').desc(), F('user_id').desc()]
+    )).values_list('cohort_id', 'user__email', 'score', 'board_rank')
+    # Window functions cannot be filtered on before Django 4.2, the ranked rows are cut in an outer query.
+    sql, params = ranked.query.sql_with_params()
+    rank_lists = {cohort_id: [] for cohort_id in cohort_ids}
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT * FROM ({sql}) ranked WHERE ranked.board_rank <= %s ORDER BY ranked.board_rank',
+            (*params, limit)
+        )
+        for cohort_id, email, score, _ in cursor.fetchall():
+            rank_lists[cohort_id].append((email, score))
+    return rank_lists
+
+def FetchRankLists(cohort_ids, limit):
+    """
+    Returns {cohort_id: top `limit` ranklist}, reading every cached board in one pipeline per node.
+    Boards that are not cached are served from one DB query and warmed in the background.
+    """
+    cohort_ids = list(dict.fromkeys(cohort_ids))
+    try:
+        return loadRankLists(cohort_ids, limit)
+    except REDIS_UNAVAILABLE_ERRORS:
+        return fetchDegraded(('batch', tuple(cohort_ids), limit), lambda: fetchTopRankListsFromDB(cohort_ids, limit))
+
+def loadRankLists(cohort_ids, limit):
+    cached = performShardedPipeline(cohort_ids, lambda pipeline, cohort_id: READ_RANK_LIST_SCRIPT(
+        keys=[
+            f'batch_rank_list:{cohort_id}.', f'batch_rank_list_fresh:{cohort_id}.',
+            f'batch_user_email:{cohort_id}.', f'batch_rank_version:{cohort_id}.'
+        ],
+        args=[0, limit - 1],
+        client=pipeline
+    ))
+    rank_lists, missing, stale = {}, [], []
+    for cohort_id in cohort_ids:
+        board, = cached[cohort_id]
+        if board is None:
+            track_cache_result("miss")
+            missing.append(cohort_id)
+            continue
+        is_fresh, rank_list, emails, _, _ = board
+        if not is_fresh and getCacheTTL(cohort_id)[0] is not None:
+            track_cache_result("stale")
+            stale.append(cohort_id)
+        else:
+            track_cache_result("hit")
+        rank_lists[cohort_id] = toRankList(cohort_id, rank_list, emails)
+    if missing:
+        rank_lists.update(fetchTopRankListsFromDB(missing, limit))
+        # Cohorts without a scored member get no board, warming them would be wasted.
+        stale += [cohort_id for cohort_id in missing if rank_lists[cohort_id]]
+    if stale:
+        scheduleRankListsWarm(stale)
+    return {cohort_id: rank_lists[cohort_id] for cohort_id in cohort_ids}
+
+def IterRankList(cohort_id, offset=0, limit=None):
+    """
+    Yield the ranklist one cached page at a time, so large boards are never held in memory.
+    Pages are read from the DB while redis is unavailable, the response has already started.
+    """
+    chunk_size = settings.SCOREBOARD_STREAM_CHUNK_SIZE
+    stop = None if limit is None else offset + limit
+    while stop is None or offset < stop:
+        size = chunk_size if stop is None else min(chunk_size, stop - offset)
+        try:
+            rank_list = loadRankList(cohort_id, offset, size)[0]
+        except REDIS_UNAVAILABLE_ERRORS:
+            rank_list = fetchDegradedRankList(cohort_id, offset, size)
+        yield from rank_list
+        if len(rank_list) < size:
+            return
+        offset += size
+
+async def loadRankListAsync(cohort_id, offset=0, limit=None):
+    SCORE_BOARD_KEY = f'batch_rank_list:{cohort_id}.'
+    FRESH_KEY = f'batch_rank_list_fresh:{cohort_id}.'
+    EMAILS_KEY = f'batch_user_email:{cohort_id}.'
+    VERSION_KEY = f'batch_rank_version:{cohort_id}.'
+    stop = -1 if limit is None else offset + limit - 1
+    cached = await performRedisScriptAsync(
+        READ_RANK_LIST_SCRIPT, [SCORE_BOARD_KEY, FRESH_KEY, EMAILS_KEY, VERSION_KEY], [offset, stop],
+        cohort_id=cohort_id
+    )
+    if cached is None:
+        return await sync_to_async(loadRankList)(cohort_id, offset, limit)
+    is_fresh, rank_list, emails, ttl, version = cached
+    if not is_fresh and getCacheTTL(cohort_id)[0] is not None:
+        track_cache_result("stale")
+        await sync_to_async(scheduleRankListRefresh)(cohort_id)
+    else:
+        track_cache_result("hit")
+    if None in emails:
+        return await sync_to_async(toRankList)(cohort_id, rank_list, emails), ttl / 1000, version
+    return toRankList(cohort_id, rank_list, emails), ttl / 1000, version
+
+async def FetchRankListPageAsync(cohort_id, offset=0, limit=None):
+    """
+    Serves cached boards without blocking the event loop, a cold board goes
+    through the single-flight rebuild of FetchRankList in a worker thread.
+    """
+    try:
+        if not settings.SCOREBOARD_LOCAL_CACHE_ENABLED:
+            return (await loadRankListAsync(cohort_id, offset, limit))[::2]
+        ensureInvalidationListener()
+        page = local_rank_lists.get((cohort_id, offset, limit))
+        if page is not None:
+            track_cache_result("local")
+        else:
+            rank_list, ttl, version = await loadRankListAsync(cohort_id, offset, limit)
+            page = (tuple(rank_list), version)
+            local_rank_lists.set((cohort_id, offset, limit), page, ttl)
+        return page
+    except REDIS_UNAVAILABLE_ERRORS:
+        return await sync_to_async(fetchDegradedRankList)(cohort_id, offset, limit), None
+
+async def FetchRankListAsync(cohort_id, offset=0, limit=None):
+    return (await FetchRankListPageAsync(cohort_id, offset, limit))[0]
+
+def snapshotField(offset, limit):
+    return f'{offset}:{"" if limit is None else limit}'
+
+def loadSnapshot(blob):
+    """
+    Snapshots are stored as the board version and the gzipped page, separated by a space.
+    """
+    version, body = blob.split(b' ', 1)
+    return body, version.decode()
+
+def storeSnapshot(cohort_id, offset, limit, rank_list, version):
+    """
+    Render and cache the page, returns its gzipped body.
+    """
+    SNAPSHOT_KEY = f'batch_rank_snapshot:{cohort_id}.'
+    VERSION_KEY = f'batch_rank_version:{cohort_id}.'
+    body = gzip.compress(renderScoreboard(rank_list), compresslevel=6, mtime=0)
+    if version is not None:
+        if getCacheTTL(cohort_id)[0] is None:
+            TTL_KEY = f'batch_rank_list:{cohort_id}.'
+        else:
+            TTL_KEY = f'batch_rank_list_fresh:{cohort_id}.'
+        performRedisScript(
+            STORE_SNAPSHOT_SCRIPT,
+            [SNAPSHOT_KEY, VERSION_KEY, TTL_KEY],
+            [snapshotField(offset, limit), version, version.encode() + b' ' + body],
+            cohort_id=cohort_id
+        )
+    return body
+
+def FetchRenderedRankList(cohort_id, offset=0, limit=None):
+    """
+    Returns (gzipped JSON page, version). The page is served from a snapshot rendered
+    next to the board, in one GET when it is there.
+    """
+    SNAPSHOT_KEY = f'batch_rank_snapshot:{cohort_id}.'
+    try:
+        blob = performRedisOps("hget", SNAPSHOT_KEY, snapshotField(offset, limit), binary=True, cohort_id=cohort_id)
+        if blob is not None:
+            track_cache_result("hit")
+            return loadSnapshot(blob)
+        rank_list, version = FetchRankListPage(cohort_id, offset, limit)
+        return storeSnapshot(cohort_id, offset, limit, rank_list, version), version
+    except REDIS_UNAVAILABLE_ERRORS:
+        return storeSnapshot(cohort_id, offset, limit, fetchDegradedRankList(cohort_id, offset, limit), None), None
+
+async def FetchRenderedRankListAsync(cohort_id, offset=0, limit=None):
+    SNAPSHOT_KEY = f'batch_rank_snapshot:{cohort_id}.'
+    try:
+        blob = await performRedisOpsAsync(
+            "hget", SNAPSHOT_KEY, snapshotField(offset, limit), binary=True, cohort_id=cohort_id
+        )
+        if blob is not None:
+            track_cache_result("hit")
+            return loadSnapshot(blob)
+        rank_list, version = await FetchRankListPageAsync(cohort_id, offset, limit)
+        return await sync_to_async(storeSnapshot)(cohort_id, offset, limit, rank_list, version), version
+    except REDIS_UNAVAILABLE_ERRORS:
+        rank_list = await sync_to_async(fetchDegradedRankList)(cohort_id, offset, limit)
+        return storeSnapshot(cohort_id, offset, limit, rank_list, None), None
+
+def aggregateKeys(cohort_ids, aggregate):
+    """
+    Returns (union, versions built from, rebuild lock) keys of the aggregate board and
+    the prefix of the copies of boards from other nodes it is built from.
+    """
+    name = f'{aggregate}:{",".join(map(str, cohort_ids))}'
+    return (
+        f'batch_aggregate_rank_list:{name}.',
+        f'batch_aggregate_rank_list_built:{name}.',
+        f'batch_aggregate_rank_list_lock:{name}.',
+        f'batch_aggregate_rank_list_part:{name}:',
+    )
+
+def fetchAggregateRankListFromDB(cohort_ids, aggregate, offset=0, limit=None):
+    track_db_hit()
+    cohort_users = CohortUser.objects.filter(
+        score__gt=0,
+        cohort_id__in=cohort_ids
+    ).values('user_id', 'user__email').annotate(
+        total=Sum('score') if aggregate == 'sum' else Max('score')
+    ).order_by('-total', '-user_id').values_list('user__email', 'total')
+    if limit is None:
+        return cohort_users[offset:]
+    return cohort_users[offset:offset + limit]
+
+def rebuildAggregateRankList(cohort_ids, aggregate):
+    """
+    Warm the missing member boards, then union them inside redis, on the node of the
+    first cohort. Boards of other nodes are copied there for the union.
+    """
+    union_key, built_key, _, part_prefix = aggregateKeys(cohort_ids, aggregate)
+    node = redisNode(cohort_ids[0])
+    local = [cohort_id for cohort_id in cohort_ids if redisNode(cohort_id) is node]
+    remote = [cohort_id for cohort_id in cohort_ids if redisNode(cohort_id) is not node]
+    cached = performShardedPipeline(
+        cohort_ids, lambda pipeline, cohort_id: pipeline.exists(f'batch_rank_list:{cohort_id}.')
+    )
+    missing = [cohort_id for cohort_id in cohort_ids if not cached[cohort_id][0]]
+    if missing:
+        warmRankLists(missing, settings.SCOREBOARD_UPDATE_CHUNK_SIZE)
+    parts = performShardedPipeline(remote, lambda pipeline, cohort_id: pipeline.zrange(
+        f'batch_rank_list:{cohort_id}.', 0, -1, withscores=True
+    ).pttl(f'batch_rank_list:{cohort_id}.'))
+    part_keys = [f'{part_prefix}{cohort_id}.' for cohort_id in remote]
+
+    def build(pipeline):
+        for cohort_id, part_key in zip(remote, part_keys):
+            members, ttl = parts[cohort_id]
+            pipeline.delete(part_key)
+            if members:
+                pipeline.zadd(part_key, dict(members))
+                pipeline.pexpire(part_key, ttl if ttl > 0 else settings.SCOREBOARD_CACHE_TTL * 1000)
+        BUILD_AGGREGATE_SCRIPT(
+            keys=[
+                union_key, built_key, *[f'batch_rank_list:{cohort_id}.' for cohort_id in local], *part_keys,
+                *[f'batch_rank_version:{cohort_id}.' for cohort_id in local]
+            ],
+            args=[len(cohort_ids), aggregate, settings.SCOREBOARD_CACHE_TTL * 1000],
+            client=pipeline
+        )
+        if part_keys:
+            pipeline.delete(*part_keys)
+
+    performRedisPipeline(build, node=node)
+
+def FetchAggregateRankList(cohort_ids, aggregate='sum', offset=0, limit=None):
+    """
+    Ranklist of the users of all the given cohorts, a user's score being the 'sum' or
+    'max' of their cohort scores. The union is cached until one of the boards changes,
+    or for boards on another node than the first cohort's, until the union expires.
+    """
+    cohort_ids = sorted(set(cohort_ids))
+    try:
+        return loadAggregateRankList(cohort_ids, aggregate, offset, limit)
+    except REDIS_UNAVAILABLE_ERRORS:
+        return fetchDegraded(
+            ('aggregate', tuple(cohort_ids), aggregate, offset, limit),
+            lambda: list(fetchAggregateRankListFromDB(cohort_ids, aggregate, offset, limit))
+        )
+
+def loadAggregateRankList(cohort_ids, aggregate, offset, limit):
+    union_key, built_key, lock_key, _ = aggregateKeys(cohort_ids, aggregate)
+    node = redisNode(cohort_ids[0])
+    local = [cohort_id for cohort_id in cohort_ids if redisNode(cohort_id) is node]
+    version_keys = [f'batch_rank_version:{cohort_id}.' for cohort_id in local]
+    email_keys = [f'batch_user_email:{cohort_id}.' for cohort_id in local]
+    stop = -1 if limit is None else offset + limit - 1
+    deadline = time.monotonic() + settings.SCOREBOARD_REBUILD_WAIT_TIMEOUT
+    rebuilt = False
+    while True:
+        # A union just built is served even if a board changed since, as a cached board would be.
+        cached = performRedisScript(
+            READ_AGGREGATE_SCRIPT,
+            [union_key, built_key, *version_keys, *email_keys],
+            [len(local), offset, stop, 0 if rebuilt else 1],
+            node=node
+        )
+        if cached is not None:
+            track_cache_result("hit")
+            rank_list, emails, _ = cached
+            # Emails are per user, one missing is cached along with the first cohort's.
+            return toRankList(cohort_ids[0], rank_list, emails)
+        token = acquireLock(lock_key, settings.SCOREBOARD_REBUILD_LOCK_TIMEOUT, cohort_id=cohort_ids[0])
+        if token is not None:
+            track_cache_result("miss")
+            try:
+                rebuildAggregateRankList(cohort_ids, aggregate)
+            finally:
+                releaseLock(lock_key, token, cohort_id=cohort_ids[0])
+            rebuilt = True
+            continue
+        if time.monotonic() >= deadline:
+            track_cache_result("miss")
+            return list(fetchAggregateRankListFromDB(cohort_ids, aggregate, offset, limit))
+        time.sleep(settings.SCOREBOARD_REBUILD_POLL_INTERVAL)
+
+def fetchCohortUserFromDB(cohort_id, user_id):
+    track_db_hit()
+    return CohortUser.objects.filter(
+        score__gt=0,
+        cohort_id=cohort_id,
+        user_id=user_id
+    ).values_list('user__email', 'score').first()
+
+def fetchUserRankFromDB(cohort_id, user_id, neighbors):
+    cohort_user = fetchCohortUserFromDB(cohort_id, user_id)
+    if cohort_user is None:
+        return None
+    cohort_users = CohortUser.objects.filter(score__gt=0, cohort_id=cohort_id)
+    score = cohort_user[1]
+    # Same tie-break as ZREVRANGE on the board members.
+    ahead = Q(score__gt=score) | Q(score=score, user_id__gt=user_id)
+    behind = Q(score__lt=score) | Q(score=score, user_id__lt=user_id)
+    track_db_hit()
+    rank = cohort_users.filter(ahead).count()
+    track_db_hit()
+    above = cohort_users.filter(ahead).order_by('score', 'user_id').values_list('user__email', 'score')[:neighbors]
+    track_db_hit()
+    below = cohort_users.filter(behind).order_by('-score', '-user_id').values_list('user__email', 'score')[:neighbors]
+    above = list(reversed(above))
+    return rank, rank - len(above), above + [cohort_user] + list(below)
+
+def FetchUserRank(cohort_id, user_id, neighbors=5):
+    """
+    Returns (rank, window_start, window) where window holds the user with up to
+    `neighbors` users above and below, or None when the user is not on the board.
+    """
+    SCORE_BOARD_KEY = f'batch_rank_list:{cohort_id}.'
+    EMAILS_KEY = f'batch_user_email:{cohort_id}.'
+    try:
+        cached = performRedisScript(
+            READ_USER_RANK_SCRIPT, [SCORE_BOARD_KEY, EMAILS_KEY], [toMember(user_id), neighbors], cohort_id=cohort_id
+        )
+    except REDIS_UNAVAILABLE_ERRORS:
+        return fetchDegraded(
+            ('user_rank', cohort_id, user_id, neighbors), lambda: fetchUserRankFromDB(cohort_id, user_id, neighbors)
+        )
+    if cached is None:
+        track_cache_result("miss")
+        return fetchUserRankFromDB(cohort_id, user_id, neighbors)
+    track_cache_result("hit")
+    if cached == -1:
+        return None
+    rank, start, window, emails = cached
+    return rank, start, toRankList(cohort_id, window, emails)
+
+def queueRankUpdates(pipeline, cohort_id, score_list):
+    """
+    Queue the script calls writing {user_id: score} to the cohort board, in chunks.
+    """
+    SCORE_BOARD_KEY = f'batch_rank_list:{cohort_id}.'
+    VERSION_KEY = f'batch_rank_version:{cohort_id}.'
+    SNAPSHOT_KEY = f'batch_rank_snapshot:{cohort_id}.'
+    members = [item for user_id, score in score_list.items() for item in (score, toMember(user_id))]
+    chunk_size = 2 * settings.SCOREBOARD_UPDATE_CHUNK_SIZE
+    for start in range(0, len(members), chunk_size):
+        UPDATE_RANK_LIST_SCRIPT(
+            keys=[SCORE_BOARD_KEY, VERSION_KEY, SNAPSHOT_KEY],
+            args=[settings.SCOREBOARD_UPDATES_CHANNEL, cohort_id, versionSeed(), *members[start:start + chunk_size]],
+            client=pipeline
+        )
+
+def updateUserRanks(cohort_id, score_list):
+    """
+    Write {user_id: score} changes to the cohort board, if it is cached, in one round trip.
+    """
+    if not score_list:
+        return
+    try:
+        performRedisPipeline(
+            lambda pipeline: queueRankUpdates(pipeline, cohort_id, score_list), transaction=False, cohort_id=cohort_id
+        )
+    except REDIS_UNAVAILABLE_ERRORS:
+        # The DB has the scores, a cached board catches up once it expires.
+        pass
+    invalidateLocalRankLists(cohort_id)
+
+def updateUserRank(user_id, cohort_id, new_score):
+    SCORE_BOARD_KEY = f'batch_rank_list:{cohort_id}.'
+    VERSION_KEY = f'batch_rank_version:{cohort_id}.'
+    SNAPSHOT_KEY = f'batch_rank_snapshot:{cohort_id}.'
+    try:
+        performRedisScript(
+            UPDATE_RANK_LIST_SCRIPT,
+            [SCORE_BOARD_KEY, VERSION_KEY, SNAPSHOT_KEY],
+            [settings.SCOREBOARD_UPDATES_CHANNEL, cohort_id, versionSeed(), new_score, toMember(user_id)],
+            cohort_id=cohort_id
+        )
+    except REDIS_UNAVAILABLE_ERRORS:
+        # The DB has the score, a cached board catches up once it expires.
+        pass
+    invalidateLocalRankLists(cohort_id)
+
+def queueUserScores(cohort_id, score_list):
+    """
+    Write behind: apply {user_id: score} to the cohort board and record it as pending,
+    in one transaction, for the flusher to persist (see cohorts.write_behind).
+    Raises REDIS_UNAVAILABLE_ERRORS when the scores could not be queued, nothing is written then.
+    """
+    PENDING_SCORES_KEY = f'batch_pending_scores:{cohort_id}.'
+    if not score_list:
+        return
+
+    def build(pipeline):
+        queueRankUpdates(pipeline, cohort_id, score_list)
+        pipeline.hset(PENDING_SCORES_KEY, mapping={toMember(user_id): score for user_id, score in score_list.items()})
+        for user_id in score_list:
+            pipeline.xadd(settings.SCOREBOARD_WRITE_BEHIND_STREAM, {"cohort_id": cohort_id, "user_id": user_id})
+
+    performRedisPipeline(build, cohort_id=cohort_id)
+    invalidateLocalRankLists(cohort_id)
+
+def bulkUpdateScores(cohort_id, scores):
+    """
+    Apply {user_id: score} to the cohort users in one transaction and push the changed
+    scores to the board once committed. Returns the ids of users found in the cohort.
+    With write behind, scores only go to the board and are persisted later.
+    """
+    if settings.SCOREBOARD_WRITE_BEHIND_ENABLED:
+        track_db_hit()
+        user_ids = list(
+            CohortUser.objects.filter(cohort_id=cohort_id, user_id__in=scores).values_list('user_id', flat=True)
+        )
+        queueUserScores(cohort_id, {user_id: scores[user_id] for user_id in user_ids})
+        return user_ids
+    with transaction.atomic():
+        track_db_hit()
+        cohort_users = list(
+            CohortUser.objects.select_for_update().filter(
+                cohort_id=cohort_id,
+                user_id__in=scores
+            ).only('id', 'user', 'score')
+        )
+        changed = [cohort_user for cohort_user in cohort_users if cohort_user.score != scores[cohort_user.user_id]]
+        deltas = {cohort_user.user_id: scores[cohort_user.user_id] - cohort_user.score for cohort_user in changed}
+        for cohort_user in changed:
+            cohort_user.score = scores[cohort_user.user_id]
+        if changed:
+            track_db_hit()
+            CohortUser.objects.bulk_update(changed, ['score'], batch_size=settings.SCOREBOARD_UPDATE_CHUNK_SIZE)
+            if settings.SCOREBOARD_WINDOWS_ENABLED:
+                from cohorts.windows import recordScoreDeltas
+                recordScoreDeltas(cohort_id, deltas)
+            score_list = {cohort_user.user_id: cohort_user.score for cohort_user in changed}
+            transaction.on_commit(lambda: updateUserRanks(cohort_id, score_list))
+    return [cohort_user.user_id for cohort_user in cohort_users]
@@ -1,3 +1,6 @@
+import json
+
+from django.conf import settings
 from rest_framework import serializers
 
 class ScoreboardSerializer(serializers.Serializer):
@@ -9,3 +12,76 @@ class ScoreboardSerializer(serializers.Serializer):
 
     def get_score(self, obj):
         return obj[1]
+
+def renderScoreboard(rank_list):
+    """
+    Same output as ScoreboardSerializer(rank_list, many=True) rendered to JSON,
+    without the per row serializer overhead.
+    """
+    return json.dumps([{"email": email, "score": score} for email, score in rank_list]).encode()
+
+def renderScoreboards(rank_lists):
+    """
+    Render {cohort_id: rank_list} as a JSON object of scoreboards keyed by cohort id.
+    """
+    return json.dumps({
+        cohort_id: [{"email": email, "score": score} for email, score in rank_list]
+        for cohort_id, rank_list in rank_lists.items()
+    }).encode()
+
+def streamScoreboard(rank_list):
+    """
+    Render an iterable of (email, score) as a JSON array, one chunk at a time.
+    """
+    yield b'['
+    separator = b''
+    for email, score in rank_list:
+        yield separator + json.dumps({"email": email, "score": score}).encode()
+        separator = b','
+    yield b']'
+
+class ScoreboardPageSerializer(serializers.Serializer):
+    offset = serializers.IntegerField(min_value=0, default=0)
+    limit = serializers.IntegerField(min_value=1, max_value=settings.SCOREBOARD_MAX_PAGE_SIZE, required=False)
+    stream = serializers.BooleanField(default=False)
+    window = serializers.ChoiceField(choices=['daily', 'weekly'], required=False)
+
+    def validate_window(self, value):
+        if not settings.SCOREBOARD_WINDOWS_ENABLED:
+            raise serializers.ValidationError("Windowed boards are not enabled.")
+        return value
+
+class AggregateScoreboardSerializer(serializers.Serializer):
+    cohort_ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=settings.SCOREBOARD_MAX_AGGREGATE_COHORTS
+    )
+    aggregate = serializers.ChoiceField(choices=['sum', 'max'], default='sum')
+    offset = serializers.IntegerField(min_value=0, default=0)
+    limit = serializers.IntegerField(min_value=1, max_value=settings.SCOREBOARD_MAX_PAGE_SIZE, required=False)
+
+class BatchScoreboardSerializer(serializers.Serializer):
+    cohort_ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=settings.SCOREBOARD_MAX_BATCH_COHORTS
+    )
+    limit = serializers.IntegerField(min_value=1, max_value=settings.SCOREBOARD_MAX_BATCH_PAGE_SIZE, default=10)
+
+class LiveScoreboardSerializer(serializers.Serializer):
+    limit = serializers.IntegerField(min_value=1, max_value=settings.SCOREBOARD_MAX_LIVE_PAGE_SIZE, default=10)
+
+class UserRankParamsSerializer(serializers.Serializer):
+    neighbors = serializers.IntegerField(min_value=0, max_value=settings.SCOREBOARD_MAX_NEIGHBORS, default=5)
+
+class ScoreUpdateSerializer(serializers.Serializer):
+    user_id = serializers.IntegerField()
+    score = serializers.IntegerField()
+
+class BulkScoreUpdateSerializer(serializers.Serializer):
+    scores = serializers.ListField(
+        child=ScoreUpdateSerializer(),
+        allow_empty=False,
+        max_length=settings.SCOREBOARD_MAX_BULK_UPDATES
+    )
@@ -1,17 +1,39 @@
+import asyncio
 import json
-import redis
+import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
+import redis
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
-from rest_framework.test import APITestCase
+from rest_framework.test import APIClient, APITestCase
 
+from cohorts import scoreboard, windows, write_behind
+from cohorts.live import LiveScoreboardRouter, diffRankLists, live_scoreboards
 from cohorts.models import *
-from commons.cost_tracker import get_operation_cost, reset_operation_cost
-
-redis_client = redis.StrictRedis('localhost', 6379, charset="utf-8", decode_responses=True)
+from commons.cost_tracker import (
+    get_operation_cost, get_operation_count, reset_operation_cost, start_tracking, stop_tracking, track_db_hit,
+    track_redis_hit
+)
+from commons import metrics
+from commons.circuit_breaker import CircuitBreaker, CircuitOpenError
+from commons.redis import (
+    HashRing, RedisNode, RedisUnavailable, performRedisOps, redis_breaker, redis_client, redis_ring
+)
 
-class GetScoreBoardTests(APITestCase):
+class ScoreBoardTestCase(APITestCase):
     fixtures = ['fixtures/initial.json', ]
 
     def setUp(self):
@@ -19,6 +41,21 @@ class GetScoreBoardTests(APITestCase):
         redis_client.flushall()
         reset_operation_cost()
 
+    def update_score(self, user_id, cohort_id, score):
+        bu = CohortUser.objects.filter(cohort_id=cohort_id, user_id=user_id).first()
+        bu.score = score
+        bu.save()
+
+    def check_cost_expectation(self, cost_min, cost_max, message=None):
+        self.assertLessEqual(get_operation_cost(), cost_max, message)
+        self.assertGreaterEqual(get_operation_cost(), cost_min, message)
+
+    def make_new_request(self, url, params=None, **extra):
+        reset_operation_cost()
+        return self.client.get(url, params, format='json', **extra)
+
+
+class GetScoreBoardTests(ScoreBoardTestCase):
     def test_should_return_200(self):
         url = reverse('cohort_scoreboard', args=[1])
         response = self.make_new_request(url)
@@ -158,15 +195,942 @@ class GetScoreBoardTests(APITestCase):
         res_3_body = json.loads(response_3.content)
         self.assertEqual(len(res_3_body), 2, "Should return updated scoreboard")
 
-    def update_score(self, user_id, cohort_id, score):
-        bu = CohortUser.objects.filter(cohort_id=cohort_id, user_id=user_id).first()
-        bu.score = score
-        bu.save()
+    def test_paginated_result_from_db_and_cache(self):
+        url = reverse('cohort_scoreboard', args=[2])
+        self.update_score(101, 2, 100)
+        self.update_score(102, 2, 1000)
+        self.update_score(103, 2, 10000)
+        response_1 = self.make_new_request(url, {'limit': 2})
 
-    def check_cost_expectation(self, cost_min, cost_max, message=None):
-        self.assertLessEqual(get_operation_cost(), cost_max, message)
-        self.assertGreaterEqual(get_operation_cost(), cost_min, message)
+        # 1st Request Expectation
+        res_1_body = json.loads(response_1.content)
+        self.assertEqual(len(res_1_body), 2, "Should return only requested page")
+        self.assertEqual(res_1_body[0].get("score"), 10000, "Validate Top Score")
+        self.check_cost_expectation(100, 200, "1st fetch should hit DB to get detail")
+
+        # Second Request
+        response_2 = self.make_new_request(url, {'offset': 1, 'limit': 1})
+
+        # 2nd Request Expectation
+        res_2_body = json.loads(response_2.content)
+        self.assertEqual(len(res_2_body), 1, "Should return only requested page")
+        self.assertEqual(res_2_body[0].get("score"), 1000, "Validate Returned Window")
+        self.check_cost_expectation(1, 50, "2nd fetch should hit cache to get detail")
+
+    def test_cached_read_is_single_round_trip(self):
+        url = reverse('cohort_scoreboard', args=[1])
+        self.update_score(1, 1, 100)
+        self.make_new_request(url)
+
+        response = self.make_new_request(url)
+        self.assertEqual(len(json.loads(response.content)), 1, "Should return non empty result")
+        self.assertEqual(get_operation_count("redis"), 1, "Cached read should be one redis round trip")
+
+    def test_unchanged_board_is_not_modified(self):
+        url = reverse('cohort_scoreboard', args=[1])
+        self.update_score(1, 1, 100)
+        etag = self.make_new_request(url)['ETag']
+
+        response = self.make_new_request(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED, "Unchanged board should not be resent")
+        self.assertEqual(response['ETag'], etag, "Not modified response should carry the ETag")
+        self.assertEqual(get_operation_count("redis"), 1, "Version check should be one redis round trip")
+
+        self.update_score(2, 1, 200)
+        response = self.make_new_request(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK, "Updated board should be resent")
+        self.assertNotEqual(response['ETag'], etag, "Updated board should have a new version")
+        self.assertEqual(len(json.loads(response.content)), 2, "Should return updated result")
+
+        async_url = reverse('cohort_scoreboard_async', args=[1])
+        async_etag = response['ETag']
+        response = self.make_new_request(async_url, HTTP_IF_NONE_MATCH=async_etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED, "Async view should honour the ETag too")
+        self.assertEqual(response['ETag'], async_etag, "Not modified response should carry the ETag")
+
+    def test_expired_board_is_resent(self):
+        url = reverse('cohort_scoreboard', args=[1])
+        self.update_score(1, 1, 100)
+        etag = self.make_new_request(url)['ETag']
+        CohortUser.objects.filter(cohort_id=1, user_id=1).update(score=300)
+
+        for view in ('cohort_scoreboard', 'cohort_scoreboard_async'):
+            redis_client.delete('batch_rank_list:1.')
+            response = self.make_new_request(reverse(view, args=[1]), HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_200_OK, "Expired board should not pin the ETag")
+            self.assertEqual(json.loads(response.content)[0]["score"], 300, "Should return the DB score")
+
+    def test_async_requests_do_not_leak_connections(self):
+        if not os.path.isdir('/proc/self/fd'):
+            self.skipTest("Open sockets are counted from /proc")
+
+        def openSockets():
+            sockets = 0
+            for fd in os.listdir('/proc/self/fd'):
+                try:
+                    sockets += os.readlink(f'/proc/self/fd/{fd}').startswith('socket:')
+                except FileNotFoundError:
+                    # The fd listdir read the directory with.
+                    pass
+            return sockets
+
+        url = reverse('cohort_scoreboard_async', args=[1])
+        self.update_score(1, 1, 100)
+        self.make_new_request(url)
+        sockets = openSockets()
+        for _ in range(20):
+            self.make_new_request(url)
+        self.assertLessEqual(openSockets(), sockets, "Each request loop should not keep its own pool")
+
+    def test_async_scoreboard_same_as_sync(self):
+        self.update_score(101, 2, 100)
+        self.update_score(102, 2, 1000)
+        sync_url = reverse('cohort_scoreboard', args=[2])
+        async_url = reverse('cohort_scoreboard_async', args=[2])
+
+        # Cold board is rebuilt through the sync path
+        res_1_body = json.loads(self.make_new_request(async_url, {'limit': 1}).content)
+        self.assertEqual(len(res_1_body), 1, "Should return only requested page")
+        self.check_cost_expectation(100, 200, "1st fetch should hit DB to get detail")
+
+        res_2_body = json.loads(self.make_new_request(async_url).content)
+        self.check_cost_expectation(1, 50, "2nd fetch should hit cache to get detail")
+        res_sync_body = json.loads(self.make_new_request(sync_url).content)
+        self.assertEqual(res_2_body, res_sync_body, "Async and sync responses should be same")
+
+    @override_settings(SCOREBOARD_STREAM_CHUNK_SIZE=2)
+    def test_streamed_result_same_as_rendered(self):
+        url = reverse('cohort_scoreboard', args=[2])
+        self.update_score(101, 2, 100)
+        self.update_score(102, 2, 1000)
+        self.update_score(103, 2, 10000)
+        res_body = json.loads(self.make_new_request(url).content)
+
+        for params in [{}, {'offset': 1}, {'offset': 1, 'limit': 1}]:
+            response = self.make_new_request(url, {'stream': 'true', **params})
+            self.assertTrue(response.streaming, "Should stream the response")
+            res_stream_body = json.loads(b''.join(response.streaming_content))
+            offset = params.get('offset', 0)
+            limit = params.get('limit', len(res_body))
+            self.assertEqual(res_stream_body, res_body[offset:offset + limit], "Streamed and rendered should be same")
+
+    def test_invalid_page_params(self):
+        url = reverse('cohort_scoreboard', args=[1])
+        response = self.make_new_request(url, {'limit': 0})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, "Limit should be positive")
+
+        response = self.make_new_request(url, {'offset': -1})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, "Offset should not be negative")
+
+
+class GetUserRankTests(ScoreBoardTestCase):
+    def setUp(self):
+        super().setUp()
+        self.update_score(101, 2, 100)
+        self.update_score(102, 2, 1000)
+        self.update_score(103, 2, 10000)
+        self.update_score(104, 2, 100000)
+
+    def test_rank_from_db_when_cache_cold(self):
+        url = reverse('cohort_user_rank', args=[2, 102])
+        response = self.make_new_request(url, {'neighbors': 1})
+
+        res_body = json.loads(response.content)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(res_body.get("rank"), 3, "Validate Returned Rank")
+        self.assertEqual(res_body.get("score"), 1000, "Validate Returned Score")
+        self.assertEqual([user["rank"] for user in res_body["above"]], [2], "Validate users above")
+        self.assertEqual([user["rank"] for user in res_body["below"]], [4], "Validate users below")
+        self.check_cost_expectation(100, 500, "Should hit DB with rank queries")
+
+    def test_rank_from_cache_same_as_db(self):
+        url = reverse('cohort_user_rank', args=[2, 103])
+        res_db_body = json.loads(self.make_new_request(url).content)
+
+        self.make_new_request(reverse('cohort_scoreboard', args=[2]))
+        response = self.make_new_request(url)
+
+        res_cache_body = json.loads(response.content)
+        self.assertEqual(res_cache_body.get("rank"), 2, "Validate Returned Rank")
+        self.assertEqual(len(res_cache_body["above"]), 1, "Should return all users above")
+        self.assertEqual(len(res_cache_body["below"]), 2, "Should return all users below")
+        self.assertEqual(res_cache_body, res_db_body, "Response from cache and DB should be same")
+
+    def test_user_without_score(self):
+        url = reverse('cohort_user_rank', args=[2, 105])
+        response = self.make_new_request(url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND, "User without score is not ranked")
 
-    def make_new_request(self, url):
+
+class ConcurrentScoreBoardTests(TransactionTestCase):
+    concurrent_requests = 10
+
+    def setUp(self):
+        super().setUp()
+        cohort = Cohort.objects.create(id=2, name='Cohort2')
+        for user_id, score in [(101, 100), (102, 1000), (103, 10000), (104, 0)]:
+            user = User.objects.create(id=user_id, email=f'Cohort2+user{user_id}@example.com')
+            CohortUser.objects.create(cohort=cohort, user=user, score=score)
+        redis_client.flushall()
         reset_operation_cost()
-        return self.client.get(url, format='json')
+
+    def test_concurrent_cold_requests_rebuild_board_once(self):
+        url = reverse('cohort_scoreboard', args=[2])
+        barrier = threading.Barrier(self.concurrent_requests)
+        fetch_from_db = scoreboard.fetchRankListFromDB
+
+        def slow_fetch_from_db(*args, **kwargs):
+            cohort_users = list(fetch_from_db(*args, **kwargs))
+            time.sleep(0.2)
+            return cohort_users
+
+        def make_request(_):
+            try:
+                barrier.wait()
+                return APIClient().get(url, format='json')
+            finally:
+                connection.close()
+
+        with mock.patch('cohorts.scoreboard.fetchRankListFromDB', side_effect=slow_fetch_from_db):
+            with ThreadPoolExecutor(self.concurrent_requests) as pool:
+                responses = list(pool.map(make_request, range(self.concurrent_requests)))
+
+        for response in responses:
+            self.assertEqual(len(json.loads(response.content)), 3, "Every request should get the full board")
+        self.assertEqual(get_operation_count("db"), 1, "Only one request should rebuild the board from DB")
+
+    def test_stale_board_served_while_refreshed_in_background(self):
+        url = reverse('cohort_scoreboard', args=[2])
+        APIClient().get(url, format='json')
+        CohortUser.objects.filter(cohort_id=2, user_id=104).update(score=100000)
+        redis_client.delete('batch_rank_list_fresh:2.')
+
+        refreshes = []
+        submit = scoreboard._refresh_executor.submit
+
+        def track_submit(*args, **kwargs):
+            refreshes.append(submit(*args, **kwargs))
+            return refreshes[-1]
+
+        reset_operation_cost()
+        with mock.patch.object(scoreboard._refresh_executor, 'submit', side_effect=track_submit):
+            response_1 = APIClient().get(url, format='json')
+            response_2 = APIClient().get(url, format='json')
+
+        self.assertEqual(len(json.loads(response_1.content)), 3, "Stale board should be served immediately")
+        self.assertEqual(len(refreshes), 1, "Only one refresh should be scheduled")
+        refreshes[0].result(timeout=5)
+        self.assertEqual(get_operation_count("db"), 1, "Board should be refreshed from DB in background")
+
+        response_3 = APIClient().get(url, format='json')
+        self.assertEqual(len(json.loads(response_3.content)), 4, "Refreshed board should be served")
+
+
+class BulkScoreUpdateTests(ScoreBoardTestCase):
+    def test_bulk_update_scores_in_db_and_cache(self):
+        url = reverse('cohort_scoreboard', args=[2])
+        self.update_score(101, 2, 100)
+        self.make_new_request(url)
+
+        scores = [
+            {"user_id": 101, "score": 500},
+            {"user_id": 102, "score": 1000},
+            {"user_id": 103, "score": 10},
+            {"user_id": 1, "score": 10},
+        ]
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('cohort_bulk_score_update', args=[2]), {"scores": scores}, format='json'
+            )
+
+        res_body = json.loads(response.content)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(res_body, {"updated": 3, "missing": [1]}, "Users outside cohort should be reported")
+        self.assertEqual(CohortUser.objects.get(cohort_id=2, user_id=102).score, 1000, "Score should be saved")
+
+        # Cached board is updated in place
+        response = self.make_new_request(url)
+        res_body = json.loads(response.content)
+        self.assertEqual([user["score"] for user in res_body], [1000, 500, 10], "Should return updated scoreboard")
+        self.check_cost_expectation(1, 50, "Should fetch detail from cache")
+
+    def test_empty_bulk_update(self):
+        response = self.client.post(reverse('cohort_bulk_score_update', args=[2]), {"scores": []}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, "Should reject empty update")
+
+
+class ScoreUpdateTests(ScoreBoardTestCase):
+    def setUp(self):
+        super().setUp()
+        self.update_score(101, 2, 100)
+        self.make_new_request(reverse('cohort_scoreboard', args=[2]))
+
+    def test_score_save_does_not_hit_users_table(self):
+        cohort_user = CohortUser.objects.get(cohort_id=2, user_id=102)
+        cohort_user.score = 1000
+        with self.assertNumQueries(1):
+            cohort_user.save()
+
+        response = self.make_new_request(reverse('cohort_scoreboard', args=[2]))
+        res_body = json.loads(response.content)
+        self.assertEqual(res_body[0], {"email": "Cohort2+user102@example.com", "score": 1000}, "Validate Returned Result")
+        self.check_cost_expectation(1, 50, "Email of new member should come from cache")
+
+    def test_score_post_query_count(self):
+        url = reverse('cohort_scoreboard', args=[2])
+        with self.assertNumQueries(2):
+            response = self.client.post(url, {"user_id": 102, "score": 1000})
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_zero_score_removed_from_cached_board(self):
+        self.update_score(101, 2, 0)
+        response = self.make_new_request(reverse('cohort_scoreboard', args=[2]))
+        self.assertEqual(len(json.loads(response.content)), 0, "Users without score should not be ranked")
+
+
+@override_settings(SCOREBOARD_LOCAL_CACHE_ENABLED=True)
+class LocalCacheTests(ScoreBoardTestCase):
+    def setUp(self):
+        super().setUp()
+        scoreboard.local_rank_lists.clear()
+        self.update_score(101, 2, 100)
+
+    def test_repeated_request_served_from_process(self):
+        url = reverse('cohort_scoreboard', args=[2])
+        self.make_new_request(url)
+        hits = scoreboard.local_rank_lists.stats()["hits"]
+
+        response = self.make_new_request(url)
+        self.assertEqual(len(json.loads(response.content)), 1, "Should return non empty result")
+        self.assertEqual(get_operation_cost(), 0, "Should not hit redis or DB")
+        self.assertEqual(scoreboard.local_rank_lists.stats()["hits"], hits + 1, "Should count local cache hit")
+
+    def test_local_update_invalidates_cohort(self):
+        url = reverse('cohort_scoreboard', args=[2])
+        self.make_new_request(url)
+        self.update_score(102, 2, 1000)
+
+        response = self.make_new_request(url)
+        self.assertEqual(len(json.loads(response.content)), 2, "Should return updated scoreboard")
+        self.check_cost_expectation(1, 50, "Should fetch detail from redis")
+
+    def test_published_update_invalidates_cohort(self):
+        url = reverse('cohort_scoreboard', args=[2])
+        self.make_new_request(url)
+        self.make_new_request(reverse('cohort_scoreboard', args=[1]))
+
+        deadline = time.monotonic() + 5
+        while not redis_client.pubsub_numsub(settings.SCOREBOARD_UPDATES_CHANNEL)[0][1] and time.monotonic() < deadline:
+            time.sleep(0.05)
+        redis_client.publish(settings.SCOREBOARD_UPDATES_CHANNEL, 2)
+        while scoreboard.local_rank_lists.get((2, 0, None)) is not None and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertIsNone(scoreboard.local_rank_lists.get((2, 0, None)), "Updated cohort should be dropped")
+        self.assertIsNotNone(scoreboard.local_rank_lists.get((1, 0, None)), "Other cohorts should stay cached")
+
+
+@override_settings(SCOREBOARD_SNAPSHOT_ENABLED=True)
+class SnapshotTests(ScoreBoardTestCase):
+    def setUp(self):
+        super().setUp()
+        self.update_score(101, 2, 100)
+        self.update_score(102, 2, 1000)
+
+    def test_snapshot_served_in_one_round_trip(self):
+        url = reverse('cohort_scoreboard', args=[2])
+        first_body = json.loads(self.make_new_request(url).content)
+
+        response = self.make_new_request(url)
+        self.assertEqual(json.loads(response.content), first_body, "Snapshot should match rendered board")
+        self.assertEqual(get_operation_count("redis"), 1, "Snapshot should be one redis round trip")
+        self.assertEqual(get_operation_count("db"), 0, "Snapshot should not hit DB")
+
+        response = self.make_new_request(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip', "Snapshot should be sent compressed")
+
+    def test_update_drops_snapshot(self):
+        url = reverse('cohort_scoreboard', args=[2])
+        etag = self.make_new_request(url)['ETag']
+        self.update_score(103, 2, 500)
+
+        response = self.make_new_request(url)
+        self.assertEqual(len(json.loads(response.content)), 3, "Should return updated scoreboard")
+        self.assertNotEqual(response['ETag'], etag, "Updated snapshot should have a new version")
+        async_response = self.make_new_request(reverse('cohort_scoreboard_async', args=[2]))
+        self.assertEqual(async_response.content, response.content, "Async view should serve the same snapshot")
+        self.assertEqual(get_operation_count("redis"), 1, "Snapshot should be one redis round trip")
+
+
+class OperationTrackingTests(ScoreBoardTestCase):
+    def test_response_reports_request_operations(self):
+        url = reverse('cohort_scoreboard', args=[1])
+        self.update_score(1, 1, 100)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.make_new_request(url)
+        self.assertEqual(response['X-Cache'], 'miss', "Cold board should be reported as miss")
+        self.assertIn(f'sql;desc="{len(queries)} calls"', response['Server-Timing'], "Should report every query")
+        self.assertEqual(response['X-Operation-Cost'], str(get_operation_cost()), "Should report request cost")
+        self.assertIn('db;desc="1 calls"', response['Server-Timing'], "Should report DB calls")
+
+        response = self.make_new_request(url)
+        self.assertEqual(response['X-Cache'], 'hit', "Cached board should be reported as hit")
+        self.assertEqual(response['X-Operation-Cost'], '1', "Should only count this request")
+        self.assertNotIn('db;', response['Server-Timing'], "Cached board should not hit DB")
+
+        metrics = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('http_requests_total{endpoint="cohort_scoreboard",status="200"}', metrics)
+        self.assertIn('http_request_duration_seconds_bucket{endpoint="cohort_scoreboard",le="+Inf"}', metrics)
+
+    def test_concurrent_requests_tracked_separately(self):
+        def request(hits):
+            tracker, token = start_tracking()
+            try:
+                for _ in range(hits):
+                    with track_redis_hit():
+                        time.sleep(0.001)
+                track_db_hit()
+            finally:
+                stop_tracking(token)
+            return tracker
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            trackers = list(executor.map(request, [3, 5]))
+        self.assertEqual([tracker.counts["redis"] for tracker in trackers], [3, 5], "Should not mix requests")
+        self.assertEqual([tracker.cost for tracker in trackers], [103, 105], "Should weigh each request")
+        self.assertGreater(trackers[0].durations["redis"], 0, "Should time redis calls")
+        self.assertEqual(get_operation_cost(), 208, "Process total should include every request")
+
+
+class WarmScoreboardsTests(ScoreBoardTestCase):
+    def test_warm_builds_boards_from_one_query(self):
+        self.update_score(1, 1, 100)
+        self.update_score(2, 1, 200)
+        self.update_score(101, 2, 50)
+        expected = {cohort_id: list(scoreboard.fetchRankListFromDB(cohort_id)) for cohort_id in (1, 2)}
+        redis_client.flushall()
+        reset_operation_cost()
+
+        warmed = scoreboard.warmRankLists([1, 2, 3], chunk_size=1)
+        self.assertEqual(warmed, {1: 2, 2: 1, 3: 0}, "Should count ranked members per cohort")
+        self.assertEqual(get_operation_count("db"), 1, "Should stream every cohort from one query")
+
+        for cohort_id in (1, 2):
+            response = self.make_new_request(reverse('cohort_scoreboard', args=[cohort_id]))
+            rank_list = [(row["email"], row["score"]) for row in json.loads(response.content)]
+            self.assertEqual(rank_list, expected[cohort_id], "Warmed board should match DB")
+            self.assertEqual(get_operation_cost(), 1, "Warmed board should be served from redis")
+
+    def test_rebuild_between_warm_chunks(self):
+        for user_id in (1, 2, 3):
+            self.update_score(user_id, 1, 100 * user_id)
+        rows = list(scoreboard.fetchScoredMembersFromDB([1]))
+
+        def rebuildingRows(chunk_size):
+            for done, row in enumerate(rows, 1):
+                yield row
+                if done == 1:
+                    # A cold board request rebuilds while the warm is between chunks.
+                    scoreboard.rebuildRankList(1)
+
+        members = mock.Mock(iterator=rebuildingRows)
+        with mock.patch('cohorts.scoreboard.fetchScoredMembersFromDB', return_value=members):
+            scoreboard.warmRankLists([1], chunk_size=1)
+        self.assertEqual(redis_client.zcard('batch_rank_list:1.'), 3, "Warmed board should keep every chunk")
+        self.assertEqual(redis_client.keys('batch_*_tmp:*'), [], "Builds should leave no tmp keys")
+
+    def test_warm_locks_each_cohort_while_it_is_built(self):
+        self.update_score(1, 1, 100)
+        self.update_score(2, 1, 200)
+        self.update_score(101, 2, 50)
+        rows = list(scoreboard.fetchScoredMembersFromDB([1, 2]))
+        self.assertEqual([row[0] for row in rows], [1, 1, 2])
+        locks = []
+
+        def lockingRows(chunk_size):
+            for done, row in enumerate(rows, 1):
+                yield row
+                # Resumed once the row's chunk is flushed.
+                locks.append((
+                    redis_client.pttl('batch_rank_list_lock:1.'), redis_client.exists('batch_rank_list_lock:2.')
+                ))
+                if done == 1:
+                    redis_client.pexpire('batch_rank_list_lock:1.', 100)
+
+        members = mock.Mock(iterator=lockingRows)
+        with mock.patch('cohorts.scoreboard.fetchScoredMembersFromDB', return_value=members):
+            warmed = scoreboard.warmRankLists([1, 2], chunk_size=1, lock=True)
+        self.assertEqual(warmed, {1: 2, 2: 1})
+        self.assertFalse(locks[0][1], "Next cohort should not be locked before its rows")
+        self.assertGreater(locks[1][0], 1000, "Lock should be refreshed with every chunk")
+        self.assertEqual(locks[2], (-2, 1), "Lock should move to the cohort being built")
+        self.assertEqual(redis_client.keys('batch_rank_list_lock:*'), [], "Warm should release its locks")
+
+    def test_command_skips_cohorts_being_rebuilt(self):
+        self.update_score(1, 1, 100)
+        self.update_score(101, 2, 50)
+        redis_client.flushall()
+        redis_client.set('batch_rank_list_lock:1.', 'request')
+        stdout = StringIO()
+        call_command('warm_scoreboards', 1, 2, stdout=stdout)
+        self.assertFalse(redis_client.exists('batch_rank_list:1.'), "Locked cohort should be left to its rebuild")
+        self.assertTrue(redis_client.exists('batch_rank_list:2.'))
+        self.assertEqual(redis_client.get('batch_rank_list_lock:1.'), 'request', "Lock should not be released")
+        self.assertIn("1 being rebuilt skipped", stdout.getvalue())
+
+
+@override_settings(SCOREBOARD_WRITE_BEHIND_ENABLED=True)
+class WriteBehindTests(ScoreBoardTestCase):
+    def setUp(self):
+        super().setUp()
+        self.update_score(101, 2, 100)
+        self.url = reverse('cohort_scoreboard', args=[2])
+        self.make_new_request(self.url)
+
+    def scores_in_db(self):
+        return dict(CohortUser.objects.filter(cohort_id=2, user_id__in=[101, 102]).values_list('user_id', 'score'))
+
+    def test_post_updates_board_and_defers_db_write(self):
+        with self.assertNumQueries(1):
+            response = self.client.post(self.url, {"user_id": 102, "score": 1000})
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        res_body = json.loads(self.make_new_request(self.url).content)
+        self.assertEqual(res_body[0]["score"], 1000, "Board should have the new score at once")
+        self.assertEqual(self.scores_in_db()[102], 0, "DB should be written by the flusher")
+
+        self.client.post(self.url, {"user_id": 102, "score": 2000})
+        self.assertEqual(write_behind.flushQueuedScoresOnce('flusher-1'), (2, 1), "Should coalesce updates")
+        self.assertEqual(self.scores_in_db()[102], 2000, "Should persist the latest score")
+        self.assertEqual(redis_client.xlen(settings.SCOREBOARD_WRITE_BEHIND_STREAM), 0, "Should drop flushed entries")
+
+    def test_unacked_batch_is_replayed(self):
+        scoreboard.bulkUpdateScores(2, {101: 300, 102: 400})
+        # The flusher reads a batch and dies before persisting it.
+        self.assertEqual(len(write_behind.readQueuedScores('flusher-1', 10)), 2)
+        self.assertEqual(write_behind.flushQueuedScoresOnce('flusher-1', block_ms=None)[1], 2, "Should replay own batch")
+        self.assertEqual(self.scores_in_db(), {101: 300, 102: 400})
+
+        scoreboard.bulkUpdateScores(2, {101: 500})
+        self.assertEqual(len(write_behind.readQueuedScores('flusher-1', 10)), 1)
+        with self.settings(SCOREBOARD_WRITE_BEHIND_CLAIM_IDLE_MS=0):
+            self.assertEqual(write_behind.flushQueuedScoresOnce('flusher-2')[1], 1, "Should claim idle batch")
+        self.assertEqual(self.scores_in_db()[101], 500)
+
+    def test_rebuild_keeps_pending_scores(self):
+        scoreboard.bulkUpdateScores(2, {102: 700})
+        redis_client.delete('batch_rank_list:2.')
+        res_body = json.loads(self.make_new_request(self.url).content)
+        self.assertEqual(res_body[0]["score"], 700, "Rebuilt board should include unflushed scores")
+        res_body = json.loads(self.make_new_request(self.url).content)
+        self.assertEqual(res_body[0]["score"], 700, "Cached board should include unflushed scores")
+
+
+@override_settings(SCOREBOARD_WINDOWS_ENABLED=True)
+class WindowedScoreBoardTests(ScoreBoardTestCase):
+    def test_window_board_follows_score_changes(self):
+        url = reverse('cohort_scoreboard', args=[2])
+        self.update_score(101, 2, 100)
+        self.update_score(102, 2, 50)
+
+        res_body = json.loads(self.make_new_request(url, {'window': 'daily'}).content)
+        self.assertEqual([row["score"] for row in res_body], [100, 50], "Should rebuild window from events")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.update_score(102, 2, 250)
+            scoreboard.bulkUpdateScores(2, {101: 90})
+        res_body = json.loads(self.make_new_request(url, {'window': 'weekly'}).content)
+        self.assertEqual([row["score"] for row in res_body], [250, 90], "Should rebuild window from events")
+        res_body = json.loads(self.make_new_request(url, {'window': 'daily'}).content)
+        self.assertEqual([row["score"] for row in res_body], [250, 90], "Should add deltas to cached window")
+        self.check_cost_expectation(1, 50, "Cached window should not hit DB")
+
+    def test_rebuild_races_score_changes(self):
+        url = reverse('cohort_scoreboard', args=[2])
+        self.update_score(101, 2, 100)
+        self.update_score(102, 2, 50)
+        # Committed before the rebuild reads, its increment only runs once the board is swapped in.
+        with self.captureOnCommitCallbacks() as before_read:
+            self.update_score(101, 2, 120)
+        fetch_window_events = windows.fetchWindowEventsFromDB
+
+        def fetchDuringCommit(*args):
+            events = list(fetch_window_events(*args))
+            # Committed after the rebuild read, its increment lands before the swap.
+            with self.captureOnCommitCallbacks(execute=True):
+                self.update_score(102, 2, 80)
+            return events
+
+        with mock.patch('cohorts.windows.fetchWindowEventsFromDB', fetchDuringCommit):
+            self.make_new_request(url, {'window': 'daily'})
+        for callback in before_read:
+            callback()
+
+        res_body = json.loads(self.make_new_request(url, {'window': 'daily'}).content)
+        self.assertEqual([row["score"] for row in res_body], [120, 80], "Each change should count once")
+
+    def test_event_committed_after_a_later_one(self):
+        url = reverse('cohort_scoreboard', args=[2])
+        self.update_score(101, 2, 100)
+        # Its id is taken first, but it commits after the rebuild read a later event.
+        with self.captureOnCommitCallbacks() as uncommitted:
+            self.update_score(102, 2, 50)
+        uncommitted_id = ScoreEvent.objects.latest('id').id
+        self.update_score(101, 2, 120)
+        fetch_window_events = windows.fetchWindowEventsFromDB
+
+        def fetchCommitted(*args):
+            return [event for event in fetch_window_events(*args) if event[0] != uncommitted_id]
+
+        with mock.patch('cohorts.windows.fetchWindowEventsFromDB', fetchCommitted):
+            self.make_new_request(url, {'window': 'daily'})
+        for callback in uncommitted:
+            callback()
+
+        res_body = json.loads(self.make_new_request(url, {'window': 'daily'}).content)
+        self.assertEqual([row["score"] for row in res_body], [120, 50], "Late event should still count")
+
+    def test_prune_keeps_current_week_events(self):
+        url = reverse('cohort_scoreboard', args=[2])
+        self.update_score(101, 2, 100)
+        self.update_score(102, 2, 50)
+        self.update_score(102, 2, 70)
+        _, week_start, _ = windows.windowBounds('weekly', timezone.now())
+        ScoreEvent.objects.filter(user_id=102).update(created_on=week_start - timedelta(seconds=1))
+        stdout = StringIO()
+
+        call_command('prune_score_events', '--batch-size', 1, stdout=stdout)
+
+        self.assertIn("Deleted 2 score events", stdout.getvalue())
+        self.assertEqual(list(ScoreEvent.objects.values_list('user_id', flat=True)), [101])
+        res_body = json.loads(self.make_new_request(url, {'window': 'weekly'}).content)
+        self.assertEqual([row["score"] for row in res_body], [100], "Current week should be kept")
+
+    def test_unknown_window_is_rejected(self):
+        response = self.make_new_request(reverse('cohort_scoreboard', args=[2]), {'window': 'yearly'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class AggregateScoreBoardTests(ScoreBoardTestCase):
+    def setUp(self):
+        super().setUp()
+        self.url = reverse('aggregate_scoreboard')
+        self.update_score(101, 2, 100)
+        self.update_score(102, 2, 300)
+        self.update_score(201, 3, 200)
+        CohortUser.objects.create(cohort_id=3, user_id=101, score=250)
+
+    def fetch(self, **params):
+        response = self.make_new_request(self.url, {'cohort_ids': [2, 3], **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [(row["email"], row["score"]) for row in json.loads(response.content)]
+
+    def test_sum_and_max_across_cohorts(self):
+        self.assertEqual(self.fetch(), [
+            ("Cohort2+user101@example.com", 350), ("Cohort2+user102@example.com", 300),
+            ("Cohort3+user201@example.com", 200),
+        ], "Should sum scores of users in several cohorts")
+        self.assertEqual(self.fetch(aggregate='max', limit=2), [
+            ("Cohort2+user102@example.com", 300), ("Cohort2+user101@example.com", 250),
+        ], "Should keep best score of users in several cohorts")
+
+    def test_union_cached_until_a_board_changes(self):
+        self.fetch()
+        self.check_cost_expectation(100, 500, "Should warm member boards from DB")
+        self.assertEqual(self.fetch(offset=1), [
+            ("Cohort2+user102@example.com", 300), ("Cohort3+user201@example.com", 200),
+        ])
+        self.check_cost_expectation(1, 1, "Cached union should be read in one round trip")
+
+        self.update_score(201, 3, 1000)
+        self.assertEqual(self.fetch(limit=1), [("Cohort3+user201@example.com", 1000)], "Should rebuild union")
+        self.check_cost_expectation(1, 50, "Union should be rebuilt from cached boards")
+
+    def test_invalid_aggregate_params(self):
+        response = self.make_new_request(self.url, {'cohort_ids': [2], 'aggregate': 'avg'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.make_new_request(self.url)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class BatchScoreBoardTests(TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        for cohort_id, scores in [(2, [100, 1000, 10000, 0]), (3, [300, 300, 30]), (4, [0])]:
+            cohort = Cohort.objects.create(id=cohort_id, name=f'Cohort{cohort_id}')
+            for i, score in enumerate(scores, 1):
+                user_id = cohort_id * 100 + i
+                user = User.objects.create(id=user_id, email=f'Cohort{cohort_id}+user{user_id}@example.com')
+                CohortUser.objects.create(cohort=cohort, user=user, score=score)
+        redis_client.flushall()
+        self.url = reverse('batch_scoreboard')
+
+    def fetch(self):
+        response = APIClient().get(self.url, {'cohort_ids': [2, 3, 4], 'limit': 2}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return json.loads(response.content), int(response['X-Operation-Cost'])
+
+    def test_misses_served_from_one_query_and_warmed(self):
+        warms = []
+        submit = scoreboard._refresh_executor.submit
+
+        def track_submit(*args, **kwargs):
+            warms.append(submit(*args, **kwargs))
+            return warms[-1]
+
+        with mock.patch.object(scoreboard._refresh_executor, 'submit', side_effect=track_submit):
+            res_body, cost = self.fetch()
+        self.assertEqual(cost // 100, 1, "Missed boards should be read with one query")
+        self.assertEqual(res_body, {
+            "2": [{"email": "Cohort2+user203@example.com", "score": 10000},
+                  {"email": "Cohort2+user202@example.com", "score": 1000}],
+            "3": [{"email": "Cohort3+user302@example.com", "score": 300},
+                  {"email": "Cohort3+user301@example.com", "score": 300}],
+            "4": [],
+        })
+        self.assertEqual(len(warms), 1, "Missed boards should be warmed together")
+        warms[0].result(timeout=5)
+
+        self.assertEqual(
+            self.fetch(), (res_body, 101), "Warmed boards should be read in one round trip, empty ones from DB"
+        )
+
+    def test_invalid_batch_params(self):
+        response = APIClient().get(self.url, {'cohort_ids': [2], 'limit': 0}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class CircuitBreakerTests(ScoreBoardTestCase):
+    def tearDown(self):
+        redis_breaker.reset()
+        scoreboard.degraded_rank_lists.clear()
+        super().tearDown()
+
+    def test_breaker_opens_and_recovers(self):
+        breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=0.05, failures=(ValueError,))
+        for _ in range(2):
+            with self.assertRaises(ValueError), breaker.guard():
+                raise ValueError()
+        self.assertEqual(breaker.state, 'open')
+        with self.assertRaises(CircuitOpenError), breaker.guard():
+            self.fail("Open circuit should fail fast")
+        self.assertEqual(metrics.registry.metrics['circuit_breaker_state'].get(breaker='test'), 1)
+
+        time.sleep(0.05)
+        with breaker.guard():
+            with self.assertRaises(CircuitOpenError), breaker.guard():
+                self.fail("Only one trial call should run while half open")
+        self.assertEqual(breaker.state, 'closed', "Successful trial should close the circuit")
+
+    def test_scoreboard_served_from_db_while_redis_is_down(self):
+        url = reverse('cohort_scoreboard', args=[2])
+        self.update_score(101, 2, 100)
+        self.update_score(102, 2, 1000)
+        expected = [{"email": "Cohort2+user102@example.com", "score": 1000},
+                    {"email": "Cohort2+user101@example.com", "score": 100}]
+
+        with mock.patch.object(redis_client, 'execute_command', side_effect=redis.exceptions.ConnectionError):
+            response = self.make_new_request(url)
+            self.assertEqual(json.loads(response.content), expected, "Should fall back to the DB")
+            self.assertNotIn('ETag', response)
+            self.check_cost_expectation(100, 200, "Should read the page from DB")
+
+            response = self.make_new_request(url)
+            self.assertEqual(json.loads(response.content), expected)
+            self.check_cost_expectation(0, 50, "Degraded page should be cached in process")
+
+            for offset in range(settings.REDIS_CIRCUIT_FAILURE_THRESHOLD):
+                self.make_new_request(url, {'offset': offset + 1})
+            self.assertEqual(redis_breaker.state, 'open', "Repeated failures should open the circuit")
+            with self.assertRaises(RedisUnavailable):
+                performRedisOps("get", 'batch_rank_version:2.')
+            self.assertEqual(get_operation_count("redis"), 0, "Open circuit should not call redis")
+
+    @override_settings(SCOREBOARD_WINDOWS_ENABLED=True)
+    def test_other_reads_served_from_db_while_redis_is_down(self):
+        self.update_score(101, 2, 100)
+        self.update_score(1, 1, 50)
+        self.update_score(102, 2, 50)
+        row = ("Cohort2+user101@example.com", 100)
+        reads = [
+            (reverse('batch_scoreboard'), {'cohort_ids': [1, 2], 'limit': 1}, lambda body: body["2"]),
+            (reverse('aggregate_scoreboard'), {'cohort_ids': [1, 2], 'limit': 1}, lambda body: body),
+            (reverse('cohort_scoreboard', args=[2]), {'window': 'daily', 'limit': 1}, lambda body: body),
+            (reverse('cohort_user_rank', args=[2, 101]), {'neighbors': 0}, lambda body: [body]),
+        ]
+        with mock.patch.object(
+            redis_client.connection_pool, 'get_connection', side_effect=redis.exceptions.ConnectionError
+        ):
+            for url, params, rows in reads:
+                response = self.make_new_request(url, params)
+                self.assertEqual(response.status_code, status.HTTP_200_OK, url)
+                first = rows(json.loads(response.content))[0]
+                self.assertEqual((first["email"], first["score"]), row, "Should fall back to the DB")
+                self.assertGreaterEqual(get_operation_count("db"), 1)
+
+                response = self.make_new_request(url, params)
+                self.assertEqual(response.status_code, status.HTTP_200_OK, url)
+                self.assertEqual(get_operation_count("db"), 0, "Degraded read should be cached in process")
+
+    @override_settings(SCOREBOARD_WINDOWS_ENABLED=True)
+    def test_score_updates_saved_while_redis_is_down(self):
+        url = reverse('cohort_scoreboard', args=[2])
+        with mock.patch.object(
+            redis_client.connection_pool, 'get_connection', side_effect=redis.exceptions.ConnectionError
+        ):
+            response = self.client.post(url, {"user_id": 101, "score": 300})
+            self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT, "Score should be saved to the DB")
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(
+                    reverse('cohort_bulk_score_update', args=[2]), {"scores": [{"user_id": 102, "score": 200}]},
+                    format='json'
+                )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            with self.settings(SCOREBOARD_WRITE_BEHIND_ENABLED=True):
+                response = self.client.post(url, {"user_id": 101, "score": 900})
+            self.assertEqual(
+                response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE, "Written behind score cannot be queued"
+            )
+        self.assertEqual(
+            dict(CohortUser.objects.filter(cohort_id=2, user_id__in=[101, 102]).values_list('user_id', 'score')),
+            {101: 300, 102: 200}
+        )
+
+    def test_streamed_scoreboard_served_from_db_while_redis_is_down(self):
+        self.update_score(101, 2, 100)
+        with mock.patch.object(redis_client, 'execute_command', side_effect=redis.exceptions.ConnectionError):
+            response = self.make_new_request(reverse('cohort_scoreboard', args=[2]), {'stream': 'true'})
+            body = b''.join(response.streaming_content)
+        self.assertEqual(json.loads(body), [{"email": "Cohort2+user101@example.com", "score": 100}])
+
+
+class ShardedScoreBoardTests(ScoreBoardTestCase):
+    def setUp(self):
+        super().setUp()
+        # A second database of the same server stands in for a second node.
+        self.nodes = [redis_ring.nodes[0], RedisNode(settings.REDIS_URL.rsplit('/', 1)[0] + '/1')]
+        self.ring = HashRing(self.nodes, settings.REDIS_RING_REPLICAS)
+        cohorts = {
+            node: [cohort_id for cohort_id in range(1, 6) if self.ring.get(cohort_id) is node] for node in self.nodes
+        }
+        if not all(cohorts.values()):
+            self.skipTest("Fixture cohorts all hash to one node")
+        self.local, self.remote = cohorts[self.nodes[0]][0], cohorts[self.nodes[1]][0]
+        for cohort_id in (self.local, self.remote):
+            self.update_score(cohort_id * 100 - 99, cohort_id, 100 * cohort_id)
+            self.update_score(cohort_id * 100 - 98, cohort_id, 10 * cohort_id)
+
+    def use_ring(self, ring):
+        patcher = mock.patch('commons.redis.redis_ring', ring)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def board_nodes(self, cohort_id):
+        return [node for node in self.nodes if node.client.exists(f'batch_rank_list:{cohort_id}.')]
+
+    def test_cohorts_served_from_their_node(self):
+        self.use_ring(self.ring)
+        for cohort_id in (self.local, self.remote):
+            self.make_new_request(reverse('cohort_scoreboard', args=[cohort_id]))
+            self.assertEqual(self.board_nodes(cohort_id), [self.ring.get(cohort_id)], "Board should be on its node")
+
+        response = self.make_new_request(reverse('batch_scoreboard'), {'cohort_ids': [self.local, self.remote]})
+        self.assertEqual(
+            [row["score"] for row in json.loads(response.content)[str(self.remote)]],
+            [100 * self.remote, 10 * self.remote]
+        )
+        self.check_cost_expectation(2, 2, "Boards should be read with one pipeline per node")
+
+        response = self.make_new_request(
+            reverse('aggregate_scoreboard'), {'cohort_ids': [self.local, self.remote], 'limit': 1}
+        )
+        self.assertEqual(json.loads(response.content), [{
+            "email": f"Cohort{self.remote}+user{self.remote * 100 - 99}@example.com", "score": 100 * self.remote
+        }], "Should union boards of both nodes")
+
+    @override_settings(SCOREBOARD_WRITE_BEHIND_ENABLED=True)
+    def test_moved_cohorts_warmed_on_their_new_node(self):
+        self.use_ring(HashRing(self.nodes[:1], settings.REDIS_RING_REPLICAS))
+        for cohort_id in (self.local, self.remote):
+            self.make_new_request(reverse('cohort_scoreboard', args=[cohort_id]))
+        scoreboard.bulkUpdateScores(self.remote, {self.remote * 100 - 98: 5000})
+
+        self.use_ring(self.ring)
+        call_command(
+            'warm_scoreboards', previous_nodes=[self.nodes[0].url], drop_moved=True, stdout=StringIO()
+        )
+        self.assertEqual(self.board_nodes(self.local), [self.nodes[0]], "Cohorts left in place should not move")
+        self.assertEqual(self.board_nodes(self.remote), [self.nodes[1]], "Moved board should leave its old node")
+        self.assertEqual(
+            scoreboard.FetchRankList(self.remote, 0, 1),
+            [(f"Cohort{self.remote}+user{self.remote * 100 - 98}@example.com", 5000)],
+            "Pending scores should move with the board"
+        )
+        self.assertEqual(write_behind.flushQueuedScoresOnce('flusher-1', node=self.nodes[1]), (1, 1))
+        self.assertEqual(CohortUser.objects.get(cohort_id=self.remote, user_id=self.remote * 100 - 98).score, 5000)
+
+
+@override_settings(SCOREBOARD_LIVE_INTERVAL=0.05)
+class LiveScoreBoardTests(ScoreBoardTestCase):
+    async def stream(self, query_string, on_snapshot=None):
+        """
+        Run a live client of cohort 2 until it got an event after its snapshot, while
+        announcing the cohort. Returns the response status and the (event, data) received.
+        """
+        sent = asyncio.Queue()
+        disconnect = asyncio.Event()
+
+        async def receive():
+            await disconnect.wait()
+            return {'type': 'http.disconnect'}
+
+        scope = {'type': 'http', 'method': 'GET', 'path': '/batch/2/scoreboard/live', 'query_string': query_string}
+        client = asyncio.ensure_future(LiveScoreboardRouter(None)(scope, receive, sent.put))
+        start = await asyncio.wait_for(sent.get(), 5)
+        events = []
+        while start['status'] == 200 and len(events) < 2:
+            if events and on_snapshot is not None:
+                await sync_to_async(on_snapshot)()
+            try:
+                body = (await asyncio.wait_for(sent.get(), 0.2))['body']
+            except asyncio.TimeoutError:
+                redis_client.publish(settings.SCOREBOARD_UPDATES_CHANNEL, 2)
+                continue
+            event, data = body.decode().split('\n', 1)
+            events.append((event[len('event: '):], json.loads(data[len('data: '):])))
+        disconnect.set()
+        await asyncio.wait_for(client, 5)
+        return start['status'], events
+
+    def test_updates_pushed_as_diffs(self):
+        self.update_score(101, 2, 100)
+        self.update_score(102, 2, 50)
+        status_code, events = async_to_sync(self.stream)(
+            b'limit=2', on_snapshot=lambda: scoreboard.updateUserRank(102, 2, 500)
+        )
+        self.assertEqual(status_code, 200)
+        self.assertEqual(events, [
+            ("snapshot", [
+                {"email": "Cohort2+user101@example.com", "score": 100},
+                {"email": "Cohort2+user102@example.com", "score": 50},
+            ]),
+            ("diff", {"size": 2, "changed": [
+                {"rank": 1, "email": "Cohort2+user102@example.com", "score": 500},
+                {"rank": 2, "email": "Cohort2+user101@example.com", "score": 100},
+            ], "removed": []}),
+        ], "Client should get its top N, then the changes")
+        self.assertEqual(live_scoreboards.subscribers, {}, "Gone clients should be dropped")
+        self.assertEqual(metrics.registry.metrics['scoreboard_live_clients'].get(), 0)
+
+    def test_diff_lists_changed_and_removed_rows(self):
+        previous = [("a", 30), ("b", 20), ("c", 10)]
+        self.assertIsNone(diffRankLists(previous, list(previous)), "Same ranklist should not be pushed")
+        self.assertEqual(diffRankLists(previous, [("a", 30), ("c", 25), ("d", 15)]), {
+            "size": 3,
+            "changed": [{"rank": 2, "email": "c", "score": 25}, {"rank": 3, "email": "d", "score": 15}],
+            "removed": ["b"],
+        })
+
+    def test_invalid_live_params(self):
+        status_code, events = async_to_sync(self.stream)(b'limit=0')
+        self.assertEqual(status_code, 400)
+        self.assertEqual(events, [])
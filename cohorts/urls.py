@@ -3,5 +3,10 @@ from django.urls import path, include
 from cohorts import views
 
 urlpatterns = [
-    path('<int:cohort_id>/scoreboard',  views.CohortScoreBoard.as_view(), name='cohort_scoreboard')
+    path('scoreboard/batch', views.BatchScoreBoard.as_view(), name='batch_scoreboard'),
+    path('scoreboard/aggregate', views.AggregateScoreBoard.as_view(), name='aggregate_scoreboard'),
+    path('<int:cohort_id>/scoreboard',  views.CohortScoreBoard.as_view(), name='cohort_scoreboard'),
+    path('<int:cohort_id>/scoreboard/async', views.AsyncCohortScoreBoard.as_view(), name='cohort_scoreboard_async'),
+    path('<int:cohort_id>/scoreboard/bulk', views.CohortBulkScoreUpdate.as_view(), name='cohort_bulk_score_update'),
+    path('<int:cohort_id>/scoreboard/users/<int:user_id>', views.CohortUserRank.as_view(), name='cohort_user_rank')
 ]
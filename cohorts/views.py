@@ -1,19 +1,97 @@
+import gzip
+import re
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
+from django.views import View
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from cohorts.models import CohortUser
-from cohorts.scoreboard import FetchRankList
-from cohorts.serializer import ScoreboardSerializer
+from cohorts.scoreboard import (
+    FetchAggregateRankList, FetchRankListPage, FetchRankListPageAsync, FetchRankLists, FetchRenderedRankList,
+    FetchRenderedRankListAsync, FetchUserRank, IterRankList, bulkUpdateScores, getRankListVersion,
+    getRankListVersionAsync, queueUserScores
+)
+from cohorts.serializer import (
+    AggregateScoreboardSerializer, BatchScoreboardSerializer, BulkScoreUpdateSerializer, ScoreboardPageSerializer,
+    ScoreboardSerializer, UserRankParamsSerializer, renderScoreboard, renderScoreboards, streamScoreboard
+)
+from cohorts.windows import FetchWindowRankList
+from commons.redis import REDIS_UNAVAILABLE_ERRORS
+
+def isNotModified(request, version):
+    if version is None:
+        return False
+    etags = parse_etags(request.headers.get('If-None-Match', ''))
+    return '*' in etags or quote_etag(version) in etags
+
+def notModifiedResponse(version):
+    response = HttpResponseNotModified()
+    response['ETag'] = quote_etag(version)
+    return response
+
+def scoreboardResponse(rank_list, version):
+    response = HttpResponse(renderScoreboard(rank_list), content_type='application/json')
+    if version is not None:
+        response['ETag'] = quote_etag(version)
+    return response
+
+def renderedScoreboardResponse(request, body, version):
+    """
+    Send the gzipped page as is to clients accepting gzip, decompress it for the rest.
+    """
+    if re.search(r'\bgzip\b', request.headers.get('Accept-Encoding', '')):
+        response = HttpResponse(body, content_type='application/json')
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(gzip.decompress(body), content_type='application/json')
+    patch_vary_headers(response, ('Accept-Encoding',))
+    if version is not None:
+        response['ETag'] = quote_etag(version)
+    return response
+
+def writeBehindUnavailable():
+    """
+    Written behind scores only live in redis until flushed, they are refused rather than lost.
+    """
+    return Response(
+        status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={'Retry-After': str(settings.REDIS_CIRCUIT_RESET_TIMEOUT)}
+    )
+
+def useSnapshot(page):
+    # Only pages from the top of the board are snapshotted, to bound the snapshot count.
+    return settings.SCOREBOARD_SNAPSHOT_ENABLED and page['offset'] == 0
 
 class CohortScoreBoard(APIView):
     def get(self, request, cohort_id, format=None):
         """
         Return a list of all users with score in ranklist with score > 0.
+        Supports `offset` and `limit` query params to fetch a window of the ranklist,
+        `stream` to send large ranklists in chunks and `window` (daily or weekly) for the
+        board of the current window only.
+        Responses carry the board version as ETag, a matching If-None-Match gets a 304.
         """
-        rank_list = FetchRankList(cohort_id)
-        results = ScoreboardSerializer(rank_list, many=True).data
-        return Response(data=results, status=status.HTTP_200_OK)
+        page = ScoreboardPageSerializer(data=request.query_params)
+        page.is_valid(raise_exception=True)
+        stream = page.validated_data.pop('stream')
+        window = page.validated_data.pop('window', None)
+        if window is not None:
+            rank_list = FetchWindowRankList(cohort_id, window, **page.validated_data)
+            return HttpResponse(renderScoreboard(rank_list), content_type='application/json')
+        if stream:
+            rank_list = IterRankList(cohort_id, **page.validated_data)
+            return StreamingHttpResponse(streamScoreboard(rank_list), content_type='application/json')
+        version = getRankListVersion(cohort_id) if 'If-None-Match' in request.headers else None
+        if isNotModified(request, version):
+            return notModifiedResponse(version)
+        if useSnapshot(page.validated_data):
+            return renderedScoreboardResponse(request, *FetchRenderedRankList(cohort_id, **page.validated_data))
+        return scoreboardResponse(*FetchRankListPage(cohort_id, **page.validated_data))
 
     def post(self, request, cohort_id, format=None):
         """
@@ -21,8 +99,98 @@ class CohortScoreBoard(APIView):
         """
         user_id = int(request.POST.get('user_id'))
         score = int(request.POST.get('score'))
+        if settings.SCOREBOARD_WRITE_BEHIND_ENABLED:
+            if CohortUser.objects.filter(user_id=user_id, cohort_id=cohort_id).exists():
+                try:
+                    queueUserScores(cohort_id, {user_id: score})
+                except REDIS_UNAVAILABLE_ERRORS:
+                    return writeBehindUnavailable()
+            return Response(status=status.HTTP_204_NO_CONTENT)
         cohort_user = CohortUser.objects.filter(user_id=user_id, cohort_id=cohort_id).first()
         if cohort_user is not None:
             cohort_user.score = score
             cohort_user.save()
         return Response(status=status.HTTP_204_NO_CONTENT)
+
+class AggregateScoreBoard(APIView):
+    def get(self, request, format=None):
+        """
+        Return the ranklist across the cohorts given as repeated `cohort_ids` query params,
+        scores being combined with `aggregate` (sum or max). Supports `offset` and `limit`.
+        """
+        params = AggregateScoreboardSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        rank_list = FetchAggregateRankList(**params.validated_data)
+        return HttpResponse(renderScoreboard(rank_list), content_type='application/json')
+
+class BatchScoreBoard(APIView):
+    def get(self, request, format=None):
+        """
+        Return the top `limit` of every cohort given as repeated `cohort_ids` query params,
+        as an object keyed by cohort id.
+        """
+        params = BatchScoreboardSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        rank_lists = FetchRankLists(**params.validated_data)
+        return HttpResponse(renderScoreboards(rank_lists), content_type='application/json')
+
+class CohortBulkScoreUpdate(APIView):
+    def post(self, request, cohort_id, format=None):
+        """
+        API to update scores for many batch users at once,
+        expects {"scores": [{"user_id": 1, "score": 10}, ...]}.
+        """
+        payload = BulkScoreUpdateSerializer(data=request.data)
+        payload.is_valid(raise_exception=True)
+        scores = {update["user_id"]: update["score"] for update in payload.validated_data["scores"]}
+        try:
+            updated = bulkUpdateScores(cohort_id, scores)
+        except REDIS_UNAVAILABLE_ERRORS:
+            return writeBehindUnavailable()
+        missing = sorted(set(scores) - set(updated))
+        return Response(data={"updated": len(updated), "missing": missing}, status=status.HTTP_200_OK)
+
+class AsyncCohortScoreBoard(View):
+    async def get(self, request, cohort_id):
+        """
+        Same as CohortScoreBoard.get, but does not hold a thread while waiting on
+        redis when served over ASGI.
+        """
+        page = ScoreboardPageSerializer(data=request.GET)
+        if not page.is_valid():
+            return JsonResponse(page.errors, status=status.HTTP_400_BAD_REQUEST)
+        page.validated_data.pop('stream')
+        window = page.validated_data.pop('window', None)
+        if window is not None:
+            rank_list = await sync_to_async(FetchWindowRankList)(cohort_id, window, **page.validated_data)
+            return HttpResponse(renderScoreboard(rank_list), content_type='application/json')
+        version = await getRankListVersionAsync(cohort_id) if 'If-None-Match' in request.headers else None
+        if isNotModified(request, version):
+            return notModifiedResponse(version)
+        if useSnapshot(page.validated_data):
+            rendered = await FetchRenderedRankListAsync(cohort_id, **page.validated_data)
+            return renderedScoreboardResponse(request, *rendered)
+        return scoreboardResponse(*await FetchRankListPageAsync(cohort_id, **page.validated_data))
+
+class CohortUserRank(APIView):
+    def get(self, request, cohort_id, user_id, format=None):
+        """
+        Return rank and score of a user along with `neighbors` users above and below.
+        """
+        params = UserRankParamsSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        user_rank = FetchUserRank(cohort_id, user_id, **params.validated_data)
+        if user_rank is None:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        rank, start, window = user_rank
+        entries = [
+            {"rank": start + position + 1, **ScoreboardSerializer(row).data}
+            for position, row in enumerate(window)
+        ]
+        user_position = rank - start
+        results = {
+            **entries[user_position],
+            "above": entries[:user_position],
+            "below": entries[user_position + 1:],
+        }
+        return Response(data=results, status=status.HTTP_200_OK)
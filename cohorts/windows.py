@@ -0,0 +1,265 @@
+"""
+Daily and weekly boards of a cohort. Score changes are recorded as ScoreEvents and
+added with ZINCRBY to the boards of the current windows, when they are cached. A
+missing board is rebuilt from the events of its window.
+"""
+import time
+from datetime import datetime, time as datetime_time, timedelta, timezone as datetime_timezone
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from cohorts.models import ScoreEvent
+from cohorts.scoreboard import fetchDegraded, toMember, toRankList
+from commons.cost_tracker import track_cache_result, track_db_hit
+from commons.redis import (
+    REDIS_UNAVAILABLE_ERRORS, acquireLock, performRedisOps, performRedisPipeline, performRedisScript,
+    registerRedisScript, releaseLock
+)
+
+WINDOWS = ('daily', 'weekly')
+
+# Applies the following event id/delta/member triples of ARGV to board KEYS[1], when it
+# is cached, skipping the events already in its set of applied event ids KEYS[2]. While a
+# rebuild runs, journal KEYS[3] exists and keeps every increment for the swap to replay.
+INCREMENT_WINDOW_SCRIPT = registerRedisScript("""
+local cached = redis.call('exists', KEYS[1]) == 1
+local journaling = redis.call('exists', KEYS[3]) == 1
+for i = 1, #ARGV, 3 do
+    if journaling then
+        redis.call('hset', KEYS[3], ARGV[i], ARGV[i + 1] .. ' ' .. ARGV[i + 2])
+    end
+    if cached and redis.call('sadd', KEYS[2], ARGV[i]) == 1 then
+        redis.call('zincrby', KEYS[1], ARGV[i + 1], ARGV[i + 2])
+    end
+end
+if cached then
+    redis.call('pexpire', KEYS[2], redis.call('pttl', KEYS[1]))
+end
+return 1
+""")
+
+# Swaps rebuilt board KEYS[1] and its applied event ids KEYS[2] in as KEYS[3] and KEYS[4],
+# for ARGV[1] seconds, with the events journaled in KEYS[5] during the rebuild which it did
+# not read added.
+SWAP_WINDOW_SCRIPT = registerRedisScript("""
+local journal = redis.call('hgetall', KEYS[5])
+for i = 1, #journal, 2 do
+    if journal[i] ~= 'rebuild' and redis.call('sadd', KEYS[2], journal[i]) == 1 then
+        local delta, member = string.match(journal[i + 1], '(%S+) (%S+)')
+        redis.call('zincrby', KEYS[1], delta, member)
+    end
+end
+redis.call('rename', KEYS[1], KEYS[3])
+redis.call('expire', KEYS[3], ARGV[1])
+redis.call('rename', KEYS[2], KEYS[4])
+redis.call('expire', KEYS[4], ARGV[1])
+redis.call('del', KEYS[5])
+return 1
+""")
+
+# Returns nil when board KEYS[1] is missing, else {flat member/score range, emails} of
+# the members with a positive score, ARGV[1] and ARGV[2] being the offset and count.
+READ_WINDOW_RANK_LIST_SCRIPT = registerRedisScript("""
+if redis.call('exists', KEYS[1]) == 0 then
+    return false
+end
+local range = redis.call('zrevrangebyscore', KEYS[1], '+inf', '(0', 'WITHSCORES', 'LIMIT', ARGV[1], ARGV[2])
+local emails = {}
+for i = 1, #range, 2 do
+    emails[#emails + 1] = redis.call('hget', KEYS[2], range[i])
+end
+return {range, emails}
+""")
+
+def windowBounds(window, when):
+    """
+    Returns (label, start, end) of the UTC day or ISO week holding `when`.
+    """
+    day = when.astimezone(datetime_timezone.utc).date()
+    if window == 'daily':
+        start_day, label = day, day.isoformat()
+    else:
+        start_day = day - timedelta(days=day.weekday())
+        year, week, _ = day.isocalendar()
+        label = f'{year}-W{week:02d}'
+    start = datetime.combine(start_day, datetime_time.min, tzinfo=datetime_timezone.utc)
+    end = start + timedelta(days=1 if window == 'daily' else 7)
+    return label, start, end
+
+def windowKey(cohort_id, window, label):
+    return f'batch_window_rank_list:{cohort_id}:{window}:{label}.'
+
+def windowKeys(cohort_id, window, label):
+    """
+    Board, applied event ids and rebuild journal keys of the window.
+    """
+    return [
+        windowKey(cohort_id, window, label),
+        f'batch_window_events:{cohort_id}:{window}:{label}.',
+        f'batch_window_journal:{cohort_id}:{window}:{label}.',
+    ]
+
+def windowTTL(end):
+    """
+    A window board lives until its window is over, and no longer than SCOREBOARD_WINDOW_CACHE_TTL.
+    """
+    return max(1, min(int((end - timezone.now()).total_seconds()), settings.SCOREBOARD_WINDOW_CACHE_TTL))
+
+def recordScoreDeltas(cohort_id, deltas):
+    """
+    Record {user_id: score change} as events and, once committed, add them to the cached
+    boards of the current windows.
+    """
+    deltas = {user_id: delta for user_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    now = timezone.now()
+    track_db_hit()
+    events = ScoreEvent.objects.bulk_create(
+        [
+            ScoreEvent(cohort_id=cohort_id, user_id=user_id, delta=delta, created_on=now)
+            for user_id, delta in deltas.items()
+        ],
+        batch_size=settings.SCOREBOARD_UPDATE_CHUNK_SIZE
+    )
+    if events[0].pk is None:
+        # Backends like MySQL do not return the ids of bulk inserted rows.
+        track_db_hit()
+        events = ScoreEvent.objects.filter(cohort_id=cohort_id, user_id__in=deltas, created_on=now)
+    members = [item for event in events for item in (event.pk, event.delta, toMember(event.user_id))]
+
+    def build(pipeline):
+        for window in WINDOWS:
+            label, _, _ = windowBounds(window, now)
+            INCREMENT_WINDOW_SCRIPT(keys=windowKeys(cohort_id, window, label), args=members, client=pipeline)
+
+    def increment():
+        try:
+            performRedisPipeline(build, transaction=False, cohort_id=cohort_id)
+        except REDIS_UNAVAILABLE_ERRORS:
+            # The events are recorded, a cached window catches up once it is rebuilt.
+            pass
+
+    transaction.on_commit(increment)
+
+def windowEvents(cohort_id, start, end):
+    return ScoreEvent.objects.filter(cohort_id=cohort_id, created_on__gte=start, created_on__lt=end)
+
+def fetchWindowEventsFromDB(cohort_id, start, end):
+    """
+    Yields the (id, user_id, delta) of the events of the window.
+    """
+    track_db_hit()
+    return windowEvents(cohort_id, start, end).values_list('id', 'user_id', 'delta').iterator(
+        chunk_size=settings.SCOREBOARD_UPDATE_CHUNK_SIZE
+    )
+
+def fetchWindowScoresFromDB(cohort_id, start, end):
+    track_db_hit()
+    return windowEvents(cohort_id, start, end).values_list('user_id').annotate(score=Sum('delta')).order_by()
+
+def pruneScoreEvents(before, batch_size):
+    """
+    Delete the events created before `before`, `batch_size` at a time, returns how many.
+    """
+    deleted = 0
+    while True:
+        track_db_hit()
+        ids = list(ScoreEvent.objects.filter(created_on__lt=before).values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        track_db_hit()
+        deleted += ScoreEvent.objects.filter(id__in=ids).delete()[0]
+
+def rebuildWindowRankList(cohort_id, window, label, start, end):
+    """
+    Rebuild the window board from its events, members whose score went down are kept
+    with their negative score so later deltas add up, they are just not ranked.
+    The board keeps the ids of the events it holds, so the increment of an event read by
+    the rebuild is skipped and any other is applied, whatever order the events committed
+    in. Increments sent during the rebuild are replayed from the journal by the swap.
+    """
+    WINDOW_KEY, EVENTS_KEY, JOURNAL_KEY = windowKeys(cohort_id, window, label)
+    WINDOW_TMP_KEY = f'batch_window_rank_list_tmp:{cohort_id}:{window}:{label}.'
+    EVENTS_TMP_KEY = f'batch_window_events_tmp:{cohort_id}:{window}:{label}.'
+    performRedisPipeline(lambda pipeline: pipeline.hset(JOURNAL_KEY, 'rebuild', 1).expire(
+        JOURNAL_KEY, settings.SCOREBOARD_BUILD_TTL
+    ), cohort_id=cohort_id)
+    score_list, event_ids = {}, []
+    for event_id, user_id, delta in fetchWindowEventsFromDB(cohort_id, start, end):
+        score_list[toMember(user_id)] = score_list.get(toMember(user_id), 0) + delta
+        event_ids.append(event_id)
+    # An empty window still gets a board, so it is not rebuilt on every read, and an event
+    # set, 0 is never an event id.
+    score_list.setdefault(toMember(0), 0)
+    event_ids.append(0)
+    chunk_size = settings.SCOREBOARD_UPDATE_CHUNK_SIZE
+
+    def build(pipeline):
+        pipeline.delete(WINDOW_TMP_KEY, EVENTS_TMP_KEY)
+        pipeline.zadd(WINDOW_TMP_KEY, score_list)
+        for chunk in range(0, len(event_ids), chunk_size):
+            pipeline.sadd(EVENTS_TMP_KEY, *event_ids[chunk:chunk + chunk_size])
+        SWAP_WINDOW_SCRIPT(
+            keys=[WINDOW_TMP_KEY, EVENTS_TMP_KEY, WINDOW_KEY, EVENTS_KEY, JOURNAL_KEY], args=[windowTTL(end)],
+            client=pipeline
+        )
+
+    performRedisPipeline(build, cohort_id=cohort_id)
+
+def fetchWindowRankListFromDB(cohort_id, start, end, offset=0, limit=None):
+    scores = sorted(
+        ((score, user_id) for user_id, score in fetchWindowScoresFromDB(cohort_id, start, end) if score > 0),
+        reverse=True
+    )
+    stop = None if limit is None else offset + limit
+    window_scores = scores[offset:stop]
+    return toRankList(
+        cohort_id,
+        [item for score, user_id in window_scores for item in (toMember(user_id), score)],
+        [None] * len(window_scores)
+    )
+
+def FetchWindowRankList(cohort_id, window, offset=0, limit=None):
+    """
+    Ranklist of the current `window` ('daily' or 'weekly') of the cohort.
+    """
+    label, start, end = windowBounds(window, timezone.now())
+    try:
+        return loadWindowRankList(cohort_id, window, label, start, end, offset, limit)
+    except REDIS_UNAVAILABLE_ERRORS:
+        return fetchDegraded(
+            ('window', cohort_id, window, label, offset, limit),
+            lambda: fetchWindowRankListFromDB(cohort_id, start, end, offset, limit)
+        )
+
+def loadWindowRankList(cohort_id, window, label, start, end, offset, limit):
+    WINDOW_KEY = windowKey(cohort_id, window, label)
+    EMAILS_KEY = f'batch_user_email:{cohort_id}.'
+    REBUILD_LOCK_KEY = f'batch_window_rank_list_lock:{cohort_id}:{window}.'
+    count = -1 if limit is None else limit
+    deadline = time.monotonic() + settings.SCOREBOARD_REBUILD_WAIT_TIMEOUT
+    while True:
+        cached = performRedisScript(
+            READ_WINDOW_RANK_LIST_SCRIPT, [WINDOW_KEY, EMAILS_KEY], [offset, count], cohort_id=cohort_id
+        )
+        if cached is not None:
+            track_cache_result("hit")
+            rank_list, emails = cached
+            return toRankList(cohort_id, rank_list, emails)
+        token = acquireLock(REBUILD_LOCK_KEY, settings.SCOREBOARD_REBUILD_LOCK_TIMEOUT, cohort_id=cohort_id)
+        if token is not None:
+            track_cache_result("miss")
+            try:
+                if not performRedisOps("exists", WINDOW_KEY, cohort_id=cohort_id):
+                    rebuildWindowRankList(cohort_id, window, label, start, end)
+            finally:
+                releaseLock(REBUILD_LOCK_KEY, token, cohort_id=cohort_id)
+            continue
+        if time.monotonic() >= deadline:
+            track_cache_result("miss")
+            return fetchWindowRankListFromDB(cohort_id, start, end, offset, limit)
+        time.sleep(settings.SCOREBOARD_REBUILD_POLL_INTERVAL)
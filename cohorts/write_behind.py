@@ -0,0 +1,145 @@
+"""
+Flusher of the write behind score updates queued by scoreboard.queueUserScores.
+
+Each update leaves the latest score of the user in the cohort's pending hash and an
+entry in the updates stream. Flushers read the stream as a consumer group, persist the
+pending scores of the users named in a batch and only then ack the entries, so a batch
+lost to a crash is replayed, by the same consumer from its own pending entries or by
+another one once they have been idle for SCOREBOARD_WRITE_BEHIND_CLAIM_IDLE_MS.
+Scores are read from the pending hash at flush time, so replays and batches flushed
+out of order never write an older score over a newer one.
+Each redis node has its own stream, next to the pending hashes of its cohorts, so an
+update is queued in a single transaction. Flushers read the streams of every node.
+"""
+import redis
+from django.conf import settings
+from django.db import transaction
+
+from cohorts.models import CohortUser
+from cohorts.scoreboard import toMember
+from cohorts.windows import recordScoreDeltas
+from commons.cost_tracker import track_db_hit
+from commons.redis import performRedisOps, performRedisPipeline, registerRedisScript
+
+# Drops the fields of pending hash KEYS[1] still holding the flushed score, given as
+# field/score pairs in ARGV, a newer score stays pending.
+CLEAR_FLUSHED_SCORES_SCRIPT = registerRedisScript("""
+for i = 1, #ARGV, 2 do
+    if redis.call('hget', KEYS[1], ARGV[i]) == ARGV[i + 1] then
+        redis.call('hdel', KEYS[1], ARGV[i])
+    end
+end
+return 1
+""")
+
+def ensureConsumerGroup(node=None):
+    try:
+        performRedisOps(
+            "xgroup_create", settings.SCOREBOARD_WRITE_BEHIND_STREAM, settings.SCOREBOARD_WRITE_BEHIND_GROUP,
+            id='0', mkstream=True, node=node
+        )
+    except redis.exceptions.ResponseError as error:
+        if 'BUSYGROUP' not in str(error):
+            raise
+
+def readQueuedScores(consumer, count, block_ms=None, node=None):
+    """
+    Returns up to `count` entries of the stream of `node` for `consumer`: its own unacked
+    ones first, then ones idle too long on other consumers, then new ones, waiting
+    `block_ms` for them.
+    """
+    stream = settings.SCOREBOARD_WRITE_BEHIND_STREAM
+    group = settings.SCOREBOARD_WRITE_BEHIND_GROUP
+    try:
+        response = performRedisOps("xreadgroup", group, consumer, {stream: '0'}, count=count, node=node)
+        entries = response[0][1] if response else []
+        if not entries:
+            entries = performRedisOps(
+                "xautoclaim", stream, group, consumer, settings.SCOREBOARD_WRITE_BEHIND_CLAIM_IDLE_MS, count=count,
+                node=node
+            )[1]
+        if not entries:
+            response = performRedisOps(
+                "xreadgroup", group, consumer, {stream: '>'}, count=count, block=block_ms, node=node
+            )
+            entries = response[0][1] if response else []
+    except redis.exceptions.ResponseError as error:
+        if 'NOGROUP' not in str(error):
+            raise
+        # The group reads the stream from its start, entries queued before it exists are kept.
+        ensureConsumerGroup(node)
+        return readQueuedScores(consumer, count, block_ms, node)
+    return entries
+
+def flushQueuedScores(entries, node=None):
+    """
+    Persist the pending scores of the users named in the `entries` of the stream of
+    `node` with one bulk update per cohort, then ack and delete the entries. Returns the
+    number of cohort users updated.
+    """
+    dirty = {}
+    for _, fields in entries:
+        # Entries deleted while pending come back without fields, they are only acked.
+        if not fields:
+            continue
+        dirty.setdefault(int(fields["cohort_id"]), set()).add(int(fields["user_id"]))
+    cohort_ids = list(dirty)
+    pending = performRedisPipeline(lambda pipeline: [
+        pipeline.hmget(f'batch_pending_scores:{cohort_id}.', [toMember(user_id) for user_id in dirty[cohort_id]])
+        for cohort_id in cohort_ids
+    ], transaction=False, node=node)
+    flushed = {
+        cohort_id: {
+            user_id: int(score) for user_id, score in zip(dirty[cohort_id], scores) if score is not None
+        }
+        for cohort_id, scores in zip(cohort_ids, pending)
+    }
+
+    updated = 0
+    with transaction.atomic():
+        for cohort_id, scores in flushed.items():
+            if not scores:
+                continue
+            track_db_hit()
+            cohort_users = list(
+                CohortUser.objects.select_for_update().filter(
+                    cohort_id=cohort_id,
+                    user_id__in=scores
+                ).only('id', 'user', 'score')
+            )
+            deltas = {
+                cohort_user.user_id: scores[cohort_user.user_id] - cohort_user.score for cohort_user in cohort_users
+            }
+            for cohort_user in cohort_users:
+                cohort_user.score = scores[cohort_user.user_id]
+            track_db_hit()
+            CohortUser.objects.bulk_update(cohort_users, ['score'], batch_size=settings.SCOREBOARD_UPDATE_CHUNK_SIZE)
+            # Windowed boards follow the DB, they see written behind scores once flushed.
+            if settings.SCOREBOARD_WINDOWS_ENABLED:
+                recordScoreDeltas(cohort_id, deltas)
+            updated += len(cohort_users)
+
+    def build(pipeline):
+        for cohort_id, scores in flushed.items():
+            if scores:
+                CLEAR_FLUSHED_SCORES_SCRIPT(
+                    keys=[f'batch_pending_scores:{cohort_id}.'],
+                    args=[item for user_id, score in scores.items() for item in (toMember(user_id), score)],
+                    client=pipeline
+                )
+        entry_ids = [entry_id for entry_id, _ in entries]
+        pipeline.xack(settings.SCOREBOARD_WRITE_BEHIND_STREAM, settings.SCOREBOARD_WRITE_BEHIND_GROUP, *entry_ids)
+        pipeline.xdel(settings.SCOREBOARD_WRITE_BEHIND_STREAM, *entry_ids)
+
+    if entries:
+        performRedisPipeline(build, node=node)
+    return updated
+
+def flushQueuedScoresOnce(consumer, count=None, block_ms=None, node=None):
+    """
+    Read and flush one batch from the stream of `node`, returns (entries, cohort users updated).
+    """
+    entries = readQueuedScores(consumer, count or settings.SCOREBOARD_WRITE_BEHIND_BATCH_SIZE, block_ms, node)
+    if not entries:
+        return 0, 0
+    return len(entries), flushQueuedScores(entries, node)
@@ -0,0 +1,106 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from . import metrics
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+STATE_VALUES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+STATE = metrics.gauge('circuit_breaker_state', 'Circuit state, 0 closed, 1 open, 2 half open, by breaker.')
+TRANSITIONS = metrics.counter('circuit_breaker_transitions_total', 'Circuit state changes, by breaker and state.')
+FAILURES = metrics.counter('circuit_breaker_failures_total', 'Failed calls, by breaker.')
+REJECTED = metrics.counter('circuit_breaker_rejected_total', 'Calls failed fast while open, by breaker.')
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Thread safe circuit breaker. After `failure_threshold` consecutive failures the
+    circuit opens and calls fail fast with `open_error` for `reset_timeout` seconds.
+    Then a single trial call is let through, half open, which closes the circuit when
+    it succeeds and opens it again when it fails.
+    Only exceptions in `failures` count as failures, others mean the service answered.
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout, failures=(Exception,), open_error=CircuitOpenError):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = failures
+        self.open_error = open_error
+        self.state = CLOSED
+        self._failure_count = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+        STATE.set(STATE_VALUES[CLOSED], breaker=name)
+
+    def _transition(self, state):
+        self.state = state
+        STATE.set(STATE_VALUES[state], breaker=self.name)
+        TRANSITIONS.inc(breaker=self.name, state=state)
+
+    def _acquire(self):
+        """
+        Returns whether the call is the half open trial, raises `open_error` when it may not run.
+        """
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._transition(HALF_OPEN)
+            if self.state == CLOSED:
+                return False
+            if self.state == HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+        REJECTED.inc(breaker=self.name)
+        raise self.open_error(f'{self.name} circuit is open')
+
+    def _record(self, succeeded, is_trial):
+        """
+        `succeeded` is None for calls interrupted before an outcome, e.g. cancelled.
+        """
+        with self._lock:
+            if is_trial:
+                self._trial_running = False
+            if succeeded is None:
+                return
+            if succeeded:
+                self._failure_count = 0
+                if self.state != CLOSED:
+                    self._transition(CLOSED)
+                return
+            FAILURES.inc(breaker=self.name)
+            self._failure_count += 1
+            if is_trial or (self.state == CLOSED and self._failure_count >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                self._transition(OPEN)
+
+    @contextmanager
+    def guard(self):
+        """
+        Run the block as one call through the breaker, it also guards awaits.
+        """
+        is_trial = self._acquire()
+        try:
+            yield
+        except self.failures:
+            self._record(False, is_trial)
+            raise
+        except Exception:
+            self._record(True, is_trial)
+            raise
+        except BaseException:
+            self._record(None, is_trial)
+            raise
+        self._record(True, is_trial)
+
+    def reset(self):
+        with self._lock:
+            self._failure_count = 0
+            self._trial_running = False
+            if self.state != CLOSED:
+                self._transition(CLOSED)
@@ -1,23 +1,110 @@
-TOTAL_OPERATION_COST = 0
+import threading
+import time
+from contextvars import ContextVar
+
 COST_FOR = {
     "db": 100,
-    "redis": 1
+    "redis": 1,
+    # Every query actually executed, timed and reported but already weighed by "db".
+    "sql": 0
 }
+# Most conclusive first, a request reading both a cached and a rebuilt page is a miss.
+CACHE_RESULTS = ("miss", "stale", "hit", "local")
+_lock = threading.Lock()
+
+class OperationTracker:
+    """
+    Counts, weighted cost and time spent per operation kind. Everything recorded on a
+    tracker is also recorded on its parent, so the process wide tracker sees it all.
+    """
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.cost = 0
+        self.counts = {}
+        self.durations = {}
+        self.cache_results = set()
+
+    def record(self, operation, count=1, duration=0.0):
+        with _lock:
+            tracker = self
+            while tracker is not None:
+                tracker.cost += COST_FOR.get(operation, 0) * count
+                tracker.counts[operation] = tracker.counts.get(operation, 0) + count
+                tracker.durations[operation] = tracker.durations.get(operation, 0.0) + duration
+                tracker = tracker.parent
+
+    def record_cache_result(self, result):
+        with _lock:
+            self.cache_results.add(result)
+
+    def cache_result(self):
+        return next((result for result in CACHE_RESULTS if result in self.cache_results), None)
+
+    def reset(self):
+        with _lock:
+            self.cost = 0
+            self.counts.clear()
+            self.durations.clear()
+            self.cache_results.clear()
+
+_process_tracker = OperationTracker()
+_current_tracker = ContextVar('operation_tracker', default=_process_tracker)
+
+class _OperationTimer:
+    """
+    Returned by the track_* helpers, the hit is already counted and using it as a
+    context manager adds the time spent in the block.
+    """
+    def __init__(self, tracker, operation):
+        self.tracker = tracker
+        self.operation = operation
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracker.record(self.operation, count=0, duration=time.perf_counter() - self.started)
+
+def start_tracking():
+    """
+    Track operations of the current context, until stop_tracking(token), on a tracker
+    of their own. Returns (tracker, token).
+    """
+    tracker = OperationTracker(parent=_process_tracker)
+    return tracker, _current_tracker.set(tracker)
+
+def stop_tracking(token):
+    _current_tracker.reset(token)
+
+def current_tracker():
+    return _current_tracker.get()
 
 def track_redis_hit():
-    update_operation_cost_for("redis")
+    return update_operation_cost_for("redis")
 
 def track_db_hit():
-    update_operation_cost_for("db")
+    return update_operation_cost_for("db")
+
+def track_sql_query():
+    return update_operation_cost_for("sql")
+
+def track_duration(operation, duration):
+    current_tracker().record(operation, count=0, duration=duration)
+
+def track_cache_result(result):
+    current_tracker().record_cache_result(result)
 
 def update_operation_cost_for(update_for):
-    global TOTAL_OPERATION_COST
-    TOTAL_OPERATION_COST += COST_FOR.get(update_for, 0)
+    tracker = current_tracker()
+    tracker.record(update_for)
+    return _OperationTimer(tracker, update_for)
 
 def get_operation_cost():
-    global TOTAL_OPERATION_COST
-    return TOTAL_OPERATION_COST
+    return _process_tracker.cost
+
+def get_operation_count(operation):
+    return _process_tracker.counts.get(operation, 0)
 
 def reset_operation_cost():
-    global TOTAL_OPERATION_COST
-    TOTAL_OPERATION_COST = 0
+    _process_tracker.reset()
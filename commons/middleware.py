@@ -0,0 +1,80 @@
+import asyncio
+import time
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.utils.decorators import sync_and_async_middleware
+
+from . import metrics
+from .cost_tracker import start_tracking, stop_tracking, track_sql_query
+
+REQUESTS = metrics.counter('http_requests_total', 'Requests served, by endpoint and status.')
+OPERATIONS = metrics.counter('http_request_operations_total', 'DB and redis calls made, by endpoint and operation.')
+CACHE_RESULTS = metrics.counter('http_request_cache_results_total', 'Scoreboard cache results, by endpoint.')
+LATENCY = metrics.histogram('http_request_duration_seconds', 'Request latency, by endpoint.')
+OPERATION_LATENCY = metrics.histogram(
+    'http_request_operation_duration_seconds', 'Time spent per request in DB and redis calls, by endpoint.'
+)
+
+def timeQuery(execute, sql, params, many, context):
+    with track_sql_query():
+        return execute(sql, params, many, context)
+
+def installQueryTimer(sender, connection, **kwargs):
+    if timeQuery not in connection.execute_wrappers:
+        connection.execute_wrappers.append(timeQuery)
+
+connection_created.connect(installQueryTimer)
+
+def recordRequest(request, response, tracker, duration):
+    """
+    Publish the request's operations to the metrics registry and in the response headers.
+    """
+    match = getattr(request, 'resolver_match', None)
+    endpoint = match.url_name if match is not None and match.url_name else 'unmatched'
+    REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    LATENCY.observe(duration, endpoint=endpoint)
+    timings = []
+    for operation in sorted(set(tracker.counts) | set(tracker.durations)):
+        count = tracker.counts.get(operation, 0)
+        operation_duration = tracker.durations.get(operation, 0.0)
+        OPERATIONS.inc(count, endpoint=endpoint, operation=operation)
+        OPERATION_LATENCY.observe(operation_duration, endpoint=endpoint, operation=operation)
+        timings.append(f'{operation};desc="{count} calls";dur={operation_duration * 1000:.3f}')
+    timings.append(f'total;dur={duration * 1000:.3f}')
+    response['Server-Timing'] = ', '.join(timings)
+    response['X-Operation-Cost'] = str(tracker.cost)
+    cache_result = tracker.cache_result()
+    if cache_result is not None:
+        CACHE_RESULTS.inc(endpoint=endpoint, result=cache_result)
+        response['X-Cache'] = cache_result
+    return response
+
+@sync_and_async_middleware
+def OperationTrackingMiddleware(get_response):
+    """
+    Track the DB and redis calls of each request on its own, see commons.cost_tracker.
+    Work done after the response is returned, such as streamed bodies, is not counted.
+    """
+    # Connections opened before this module was loaded missed connection_created.
+    for connection in connections.all(initialized_only=True):
+        installQueryTimer(None, connection)
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            tracker, token = start_tracking()
+            started = time.perf_counter()
+            try:
+                response = await get_response(request)
+            finally:
+                stop_tracking(token)
+            return recordRequest(request, response, tracker, time.perf_counter() - started)
+    else:
+        def middleware(request):
+            tracker, token = start_tracking()
+            started = time.perf_counter()
+            try:
+                response = get_response(request)
+            finally:
+                stop_tracking(token)
+            return recordRequest(request, response, tracker, time.perf_counter() - started)
+    return middleware
@@ -1,8 +1,295 @@
+import asyncio
+import bisect
+import hashlib
+import threading
+import time
+import uuid
+import weakref
+from urllib.parse import urlparse
+
 import redis
+import redis.asyncio
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from .circuit_breaker import CircuitBreaker, CircuitOpenError
 from .cost_tracker import track_redis_hit
 
-redis_client = redis.StrictRedis('localhost', 6379, charset="utf-8", decode_responses=True)
+def _connectionPoolKwargs(decode_responses=True):
+    return {
+        "max_connections": settings.REDIS_MAX_CONNECTIONS,
+        "timeout": settings.REDIS_POOL_TIMEOUT,
+        "socket_timeout": settings.REDIS_SOCKET_TIMEOUT,
+        "socket_connect_timeout": settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+        "retry_on_timeout": settings.REDIS_RETRY_ON_TIMEOUT,
+        "health_check_interval": settings.REDIS_HEALTH_CHECK_INTERVAL,
+        "decode_responses": decode_responses,
+    }
+
+class RedisUnavailable(CircuitOpenError, redis.exceptions.ConnectionError):
+    """
+    Raised without calling redis while its circuit is open.
+    """
+
+# Errors meaning redis could not answer, callers may fall back to the DB on these.
+REDIS_UNAVAILABLE_ERRORS = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+
+def nodeName(url):
+    """
+    Name of the node at `url` without its credentials, e.g. 'localhost:6379/0'.
+    """
+    parsed = urlparse(url)
+    if parsed.hostname is None:
+        return parsed.path
+    return f'{parsed.hostname}:{parsed.port or 6379}/{parsed.path.lstrip("/") or 0}'
+
+
+class RedisNode:
+    """
+    Clients and circuit breaker of one redis server.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.name = nodeName(url)
+        self.client = redis.StrictRedis(
+            connection_pool=redis.BlockingConnectionPool.from_url(url, **_connectionPoolKwargs())
+        )
+        # Replies are left as bytes, for values which are not text such as compressed payloads.
+        self.binary_client = redis.StrictRedis(
+            connection_pool=redis.BlockingConnectionPool.from_url(url, **_connectionPoolKwargs(decode_responses=False))
+        )
+        self.breaker = CircuitBreaker(
+            f'redis:{self.name}',
+            failure_threshold=settings.REDIS_CIRCUIT_FAILURE_THRESHOLD,
+            reset_timeout=settings.REDIS_CIRCUIT_RESET_TIMEOUT,
+            failures=REDIS_UNAVAILABLE_ERRORS,
+            open_error=RedisUnavailable,
+        )
+        # asyncio connections are bound to the event loop that opened them, only server loops get some.
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    def getAsyncClient(self, binary=False):
+        loop_clients = self._async_clients.setdefault(asyncio.get_running_loop(), {})
+        if binary not in loop_clients:
+            loop_clients[binary] = redis.asyncio.StrictRedis(
+                connection_pool=redis.asyncio.BlockingConnectionPool.from_url(
+                    self.url, **_connectionPoolKwargs(decode_responses=not binary)
+                )
+            )
+        return loop_clients[binary]
+
+
+def _ringHash(value):
+    # Stable across processes, unlike hash().
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    Consistent hash ring placing each node at `replicas` points, so cohorts spread
+    evenly and adding a node only moves the cohorts it takes over.
+    """
+
+    def __init__(self, nodes, replicas):
+        self.nodes = list(nodes)
+        points = sorted(
+            (_ringHash(f'{node.name}#{replica}'), index)
+            for index, node in enumerate(self.nodes) for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._points = [self.nodes[index] for _, index in points]
+
+    def get(self, shard_key):
+        if len(self.nodes) == 1:
+            return self.nodes[0]
+        index = bisect.bisect(self._hashes, _ringHash(str(shard_key))) % len(self._hashes)
+        return self._points[index]
+
+
+redis_ring = HashRing([RedisNode(url) for url in settings.REDIS_NODES], settings.REDIS_RING_REPLICAS)
+
+# Clients of the first node, which also holds the keys not tied to a cohort.
+redis_client = redis_ring.nodes[0].client
+redis_binary_client = redis_ring.nodes[0].binary_client
+redis_breaker = redis_ring.nodes[0].breaker
+
+def redisNode(cohort_id=None):
+    """
+    Node holding the keys of the cohort, the first node when `cohort_id` is None.
+    """
+    if cohort_id is None:
+        return redis_ring.nodes[0]
+    return redis_ring.get(cohort_id)
+
+def getAsyncRedisClient(binary=False, cohort_id=None):
+    return redisNode(cohort_id).getAsyncClient(binary)
+
+# Event loops of the ASGI server, which live as long as the process. Async code running in
+# any other loop, e.g. one async_to_sync opens per request under WSGI, uses the sync clients,
+# as connection pools of short lived loops would never be closed.
+_server_loops = weakref.WeakSet()
+
+def registerServerLoop():
+    _server_loops.add(asyncio.get_running_loop())
+
+def inServerLoop():
+    return asyncio.get_running_loop() in _server_loops
+
+def performRedisOps(operation, *args, binary=False, cohort_id=None, node=None, **kwargs):
+    node = node or redisNode(cohort_id)
+    client = node.binary_client if binary else node.client
+    with node.breaker.guard(), track_redis_hit():
+        return getattr(client, operation)(*args, **kwargs)
+
+async def performRedisOpsAsync(operation, *args, binary=False, cohort_id=None, node=None, **kwargs):
+    node = node or redisNode(cohort_id)
+    if not inServerLoop():
+        return await sync_to_async(performRedisOps)(operation, *args, binary=binary, node=node, **kwargs)
+    with node.breaker.guard(), track_redis_hit():
+        return await getattr(node.getAsyncClient(binary), operation)(*args, **kwargs)
+
+def performRedisPipeline(build, transaction=True, cohort_id=None, node=None):
+    """
+    Queue commands on a pipeline with `build(pipeline)` and send them in a single
+    round trip, which is tracked as one redis hit. Returns the list of replies.
+    """
+    node = node or redisNode(cohort_id)
+    with node.client.pipeline(transaction=transaction) as pipeline:
+        build(pipeline)
+        with node.breaker.guard(), track_redis_hit():
+            return pipeline.execute()
+
+def performShardedPipeline(cohort_ids, build, transaction=False):
+    """
+    Queue the commands of every cohort with `build(pipeline, cohort_id)` on the pipeline
+    of its node, None standing for the first node, and send one pipeline per node.
+    Returns {cohort_id: list of the replies to its commands}.
+    """
+    groups = {}
+    for cohort_id in cohort_ids:
+        groups.setdefault(redisNode(cohort_id), []).append(cohort_id)
+    replies = {}
+    for node, node_cohort_ids in groups.items():
+        spans = []
+        with node.client.pipeline(transaction=transaction) as pipeline:
+            for cohort_id in node_cohort_ids:
+                start = len(pipeline)
+                build(pipeline, cohort_id)
+                spans.append((cohort_id, start, len(pipeline)))
+            with node.breaker.guard(), track_redis_hit():
+                results = pipeline.execute()
+        for cohort_id, start, stop in spans:
+            replies[cohort_id] = results[start:stop]
+    return replies
+
+_registered_scripts = []
+
+def registerRedisScript(source):
+    """
+    Register a Lua script, it is run with EVALSHA and loaded on first NOSCRIPT reply.
+    """
+    script = redis_client.register_script(source)
+    _registered_scripts.append(script)
+    return script
+
+def loadRedisScripts():
+    """
+    Load every registered script up front, e.g. on fresh servers, in one round trip per node.
+    """
+    for node in redis_ring.nodes:
+        performRedisPipeline(
+            lambda pipeline: [pipeline.script_load(script.script) for script in _registered_scripts],
+            transaction=False,
+            node=node
+        )
+
+def performRedisScript(script, keys=(), args=(), cohort_id=None, node=None):
+    node = node or redisNode(cohort_id)
+    with node.breaker.guard(), track_redis_hit():
+        return script(keys=list(keys), args=list(args), client=node.client)
+
+async def performRedisScriptAsync(script, keys=(), args=(), cohort_id=None, node=None):
+    node = node or redisNode(cohort_id)
+    if not inServerLoop():
+        return await sync_to_async(performRedisScript)(script, keys, args, node=node)
+    client = node.getAsyncClient()
+    with node.breaker.guard(), track_redis_hit():
+        try:
+            return await client.evalsha(script.sha, len(keys), *keys, *args)
+        except redis.exceptions.NoScriptError:
+            return await client.eval(script.script, len(keys), *keys, *args)
+
+RELEASE_LOCK_SCRIPT = registerRedisScript("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+""")
+
+EXTEND_LOCK_SCRIPT = registerRedisScript("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+def acquireLock(lock_key, timeout, cohort_id=None):
+    """
+    Try to take a short lived lock, returns the token needed to release it or None.
+    """
+    token = uuid.uuid4().hex
+    if performRedisOps("set", lock_key, token, px=int(timeout * 1000), nx=True, cohort_id=cohort_id):
+        return token
+    return None
+
+def releaseLock(lock_key, token, cohort_id=None):
+    return performRedisScript(RELEASE_LOCK_SCRIPT, [lock_key], [token], cohort_id=cohort_id)
+
+def acquireLocks(lock_keys, timeout):
+    """
+    Try to take the locks {cohort_id: lock_key} in one round trip per node, returns
+    {cohort_id: token} of those taken.
+    """
+    tokens = {cohort_id: uuid.uuid4().hex for cohort_id in lock_keys}
+    taken = performShardedPipeline(lock_keys, lambda pipeline, cohort_id: pipeline.set(
+        lock_keys[cohort_id], tokens[cohort_id], px=int(timeout * 1000), nx=True
+    ))
+    return {cohort_id: tokens[cohort_id] for cohort_id, (ok,) in taken.items() if ok}
+
+def releaseLocks(lock_keys, tokens):
+    """
+    Release the locks {cohort_id: lock_key} taken with {cohort_id: token}.
+    """
+    return performShardedPipeline(tokens, lambda pipeline, cohort_id: RELEASE_LOCK_SCRIPT(
+        keys=[lock_keys[cohort_id]], args=[tokens[cohort_id]], client=pipeline
+    ))
+
+def subscribeRedisChannel(channel, on_message, on_reconnect=None):
+    """
+    Call `on_message(data)` from a daemon thread per node for every message published
+    on `channel` on any node. `on_reconnect()` is called whenever a subscription was lost,
+    as messages may have been missed in between.
+    """
+    def listen(node):
+        while True:
+            pubsub = node.client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(channel)
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None:
+                        on_message(message['data'])
+            except redis.exceptions.RedisError:
+                if on_reconnect is not None:
+                    on_reconnect()
+                time.sleep(1)
+            finally:
+                pubsub.close()
 
-def performRedisOps(operation, *args):
-    track_redis_hit()
-    return getattr(redis_client, operation)(*args)
+    listeners = [
+        threading.Thread(target=listen, args=(node,), name=f'redis-subscriber:{node.name}:{channel}', daemon=True)
+        for node in redis_ring.nodes
+    ]
+    for listener in listeners:
+        listener.start()
+    return listeners
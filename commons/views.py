@@ -0,0 +1,9 @@
+from django.http import HttpResponse
+
+from . import metrics
+
+def Metrics(request):
+    """
+    Expose the request counters and latency histograms for prometheus to scrape.
+    """
+    return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4')
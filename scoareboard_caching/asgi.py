@@ -13,4 +13,16 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'scoareboard_caching.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported once Django is set up.
+from cohorts.live import LiveScoreboardRouter  # noqa: E402
+from commons.redis import registerServerLoop  # noqa: E402
+
+live_application = LiveScoreboardRouter(django_application)
+
+
+async def application(scope, receive, send):
+    # Requests served here run in the server loop, which may keep redis connections.
+    registerServerLoop()
+    await live_application(scope, receive, send)
@@ -0,0 +1,20 @@
+"""
+Settings to run the scoreboard benchmark offline, against SQLite. --fakeredis needs the
+packages of requirements-dev.txt:
+
+    pip install -r requirements-dev.txt
+    DJANGO_SETTINGS_MODULE=scoareboard_caching.benchmark_settings python manage.py migrate
+    DJANGO_SETTINGS_MODULE=scoareboard_caching.benchmark_settings python manage.py benchmark_scoreboard --fakeredis
+"""
+
+from .settings import *
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'benchmark.sqlite3',
+        'OPTIONS': {
+            'timeout': 30,
+        },
+    }
+}
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -50,6 +51,7 @@ REST_FRAMEWORK = {
 }
 
 MIDDLEWARE = [
+    'commons.middleware.OperationTrackingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -97,6 +99,27 @@ DATABASES = {
     }  
 }  
 
+# Redis
+# Clients share a bounded pool, callers wait up to REDIS_POOL_TIMEOUT seconds for a
+# free connection instead of opening new ones.
+
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+# Cohort keys are spread over these nodes by consistent hashing of the cohort id, keys
+# not tied to a cohort stay on the first one. After changing the list, move the boards
+# with `manage.py warm_scoreboards --previous-nodes <old urls>`.
+REDIS_NODES = os.environ.get('REDIS_NODES', REDIS_URL).split(',')
+REDIS_RING_REPLICAS = 160
+REDIS_MAX_CONNECTIONS = 50
+REDIS_POOL_TIMEOUT = 1
+REDIS_SOCKET_TIMEOUT = 0.5
+REDIS_SOCKET_CONNECT_TIMEOUT = 0.5
+REDIS_RETRY_ON_TIMEOUT = True
+REDIS_HEALTH_CHECK_INTERVAL = 30
+# After REDIS_CIRCUIT_FAILURE_THRESHOLD consecutive connection errors or timeouts, redis
+# calls fail fast for REDIS_CIRCUIT_RESET_TIMEOUT seconds, then one call tries it again.
+REDIS_CIRCUIT_FAILURE_THRESHOLD = 5
+REDIS_CIRCUIT_RESET_TIMEOUT = 5
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -136,3 +159,66 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Scoreboard cache
+
+SCOREBOARD_MAX_PAGE_SIZE = 1000
+SCOREBOARD_MAX_NEIGHBORS = 50
+SCOREBOARD_MAX_BULK_UPDATES = 10000
+SCOREBOARD_MAX_AGGREGATE_COHORTS = 50
+SCOREBOARD_MAX_BATCH_COHORTS = 500
+SCOREBOARD_MAX_BATCH_PAGE_SIZE = 100
+SCOREBOARD_MAX_LIVE_PAGE_SIZE = 100
+# Rows read from redis per chunk of a streamed scoreboard
+SCOREBOARD_STREAM_CHUNK_SIZE = 1000
+# Rows per bulk UPDATE and members per cached ZADD call
+SCOREBOARD_UPDATE_CHUNK_SIZE = 1000
+# A board is never served once it is older than SCOREBOARD_CACHE_TTL seconds. After
+# SCOREBOARD_CACHE_SOFT_TTL seconds it is still served, while one background worker
+# refreshes it from the DB. Set the soft TTL to None to disable background refresh.
+SCOREBOARD_CACHE_TTL = 30
+SCOREBOARD_CACHE_SOFT_TTL = 20
+# Per cohort overrides, e.g. {1: {'soft': 10, 'hard': 30}}
+SCOREBOARD_COHORT_CACHE_TTL = {}
+SCOREBOARD_REFRESH_WORKERS = 4
+# Boards are built aside in tmp keys, those of an interrupted build expire after this long.
+SCOREBOARD_BUILD_TTL = 300
+
+# Score updates and rebuilds are announced on this channel with the cohort id.
+SCOREBOARD_UPDATES_CHANNEL = 'scoreboard_updates'
+
+# Live boards streamed by the ASGI app (see cohorts.live): announced updates are pushed
+# as diffs of the top N at most every SCOREBOARD_LIVE_INTERVAL seconds. A client more than
+# SCOREBOARD_LIVE_QUEUE_SIZE events behind gets the whole top N again.
+SCOREBOARD_LIVE_INTERVAL = 0.5
+SCOREBOARD_LIVE_KEEPALIVE = 15
+SCOREBOARD_LIVE_QUEUE_SIZE = 32
+
+# Optional per process cache of served pages in front of redis. Entries are dropped
+# on update announcements and never outlive the redis board they were read from.
+SCOREBOARD_LOCAL_CACHE_ENABLED = False
+SCOREBOARD_LOCAL_CACHE_TTL = 5
+SCOREBOARD_LOCAL_CACHE_MAX_ENTRIES = 1000
+# While redis is unavailable pages are read from the DB, and kept in process this long.
+SCOREBOARD_DEGRADED_CACHE_TTL = 5
+SCOREBOARD_DEGRADED_CACHE_MAX_ENTRIES = 1000
+# Keep gzipped renders of the top pages in redis, next to the board.
+SCOREBOARD_SNAPSHOT_ENABLED = False
+# Write behind: score updates go to redis and a stream, the flush_scores command
+# persists them to the DB in batches.
+SCOREBOARD_WRITE_BEHIND_ENABLED = False
+SCOREBOARD_WRITE_BEHIND_STREAM = 'scoreboard_score_updates'
+SCOREBOARD_WRITE_BEHIND_GROUP = 'scoreboard_flushers'
+SCOREBOARD_WRITE_BEHIND_BATCH_SIZE = 1000
+SCOREBOARD_WRITE_BEHIND_BLOCK_MS = 1000
+SCOREBOARD_WRITE_BEHIND_CLAIM_IDLE_MS = 60000
+# Daily and weekly boards, kept up to date with score deltas recorded as ScoreEvents.
+# A window board is rebuilt from the events at least every SCOREBOARD_WINDOW_CACHE_TTL seconds.
+SCOREBOARD_WINDOWS_ENABLED = False
+SCOREBOARD_WINDOW_CACHE_TTL = 3600
+
+# Only one worker rebuilds a cold board, others poll for it until the wait timeout
+# and then read their page straight from the DB.
+SCOREBOARD_REBUILD_LOCK_TIMEOUT = 5
+SCOREBOARD_REBUILD_WAIT_TIMEOUT = 2
+SCOREBOARD_REBUILD_POLL_INTERVAL = 0.05
@@ -16,7 +16,10 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from commons.views import Metrics
+
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path('batch/', include('cohorts.urls'))
+    path('batch/', include('cohorts.urls')),
+    path('metrics', Metrics, name='metrics'),
 ]